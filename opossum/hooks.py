@@ -100,6 +100,22 @@ doctype_js = {"Item": "public/js/hiboutik_sync.js"}
 # 	}
 # }
 
+doc_events = {
+    "Item": {
+        "on_update": "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.mark_item_for_sync"
+    },
+    "Item Price": {
+        "on_update": "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.mark_item_for_sync"
+    },
+    "Bin": {
+        "on_update": "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.mark_item_for_sync"
+    },
+    # Stock moves update the Bin without saving it
+    "Stock Ledger Entry": {
+        "on_submit": "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.mark_item_for_sync"
+    },
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -121,6 +137,21 @@ doctype_js = {"Item": "public/js/hiboutik_sync.js"}
 # 	]
 # }
 
+scheduler_events = {
+    "cron": {
+        "* * * * *": [
+            "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.enqueue_pending_item_syncs",
+            "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.process_pending_sales",
+        ]
+    },
+    "hourly": [
+        "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.resume_stale_sync_runs"
+    ],
+    "daily": [
+        "opossum.opossum.doctype.hiboutik_api_metrics.hiboutik_api_metrics.purge_old_snapshots"
+    ],
+}
+
 # Testing
 # -------
 
@@ -0,0 +1,171 @@
+"""Benchmark of the bulk catalog sync against the local Hiboutik stand-in.
+
+Syncs synthetic catalogs through `sync_items`, the code path of
+`sync_all_items`, and reports items per second, HTTP calls per item and
+peak Python memory. Catalogs mix stocked and non-stocked items, and items
+that are new, changed or unchanged on the Hiboutik side.
+
+    python -m opossum.opossum.benchmarks.bench_catalog_sync --sizes 100 1000 10000
+
+The client is not rate limited by default (see --rate) so that the numbers
+reflect the sync code and the simulated latency, not the production quotas.
+In production, the client is bounded by the Max Concurrent Requests and Max
+Requests Per Second of the Hiboutik Settings: pass them as --max-in-flight and
+--rate to see what a site can expect.
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import List
+
+from opossum.opossum.hiboutik import HiboutikAPI, ProductData
+from opossum.opossum.hiboutik_async import DEFAULT_MAX_IN_FLIGHT, sync_items
+from opossum.opossum.models import Item
+from opossum.opossum.tests.fake_hiboutik import FakeHiboutik, FakeHiboutikServer
+from opossum.opossum.throttling import RequestScheduler
+
+DEFAULT_SIZES = (100, 1000, 10000)
+
+NEW, CHANGED, UNCHANGED = "new", "changed", "unchanged"
+
+
+def make_catalog(hiboutik: FakeHiboutik, size: int, seed: int = 0) -> List[Item]:
+    """Returns `size` items, about a third of each kind, half of them stocked.
+    Changed and unchanged items are added to the stand-in's catalog."""
+    rand = random.Random(seed)
+    items = []
+    for n in range(size):
+        kind = (NEW, CHANGED, UNCHANGED)[n % 3]
+        is_stock_item = rand.random() < 0.5
+        item = Item(
+            code=f"bench-{n}",
+            name=f"Bench item {n}",
+            price=str(rand.randint(1, 100)),
+            vat=rand.randint(1, 5),
+            is_stock_item=is_stock_item,
+            stock_qty=rand.randint(0, 50) if is_stock_item else 0,
+        )
+        if kind != NEW:
+            data = ProductData.create(item).data
+            if kind == CHANGED:
+                data["product_price"] = str(int(item.price) + 1)
+            product_id = hiboutik.add_product(
+                data["product_model"],
+                product_price=data["product_price"],
+                product_vat=data["product_vat"],
+                stock=item.stock_qty + (1 if kind == CHANGED else 0),
+            )
+            hiboutik.products[product_id]["product_stock_management"] = data[
+                "product_stock_management"
+            ]
+            item.external_id = str(product_id)
+        items.append(item)
+    return items
+
+
+@dataclass
+class BenchResult:
+    size: int
+    seconds: float
+    calls: int
+    failures: int
+    peak_memory: int = 0
+
+    @property
+    def items_per_second(self) -> float:
+        return self.size / self.seconds
+
+    @property
+    def calls_per_item(self) -> float:
+        return self.calls / self.size
+
+
+def run(
+    size: int,
+    latency: float,
+    max_in_flight: int,
+    rate: float,
+    trace_memory: bool = True,
+    session_per_worker: bool = False,
+) -> BenchResult:
+    with FakeHiboutikServer(latency=latency, seed=size) as server:
+        items = make_catalog(server.hiboutik, size)
+        server.hiboutik.calls.clear()
+        api = HiboutikAPI(
+            "bench",
+            "user",
+            "key",
+            api_root=server.api_root,
+            pool_maxsize=max_in_flight,
+            scheduler=RequestScheduler(
+                rate=rate, burst=rate, max_concurrency=max_in_flight
+            ),
+            session_per_worker=session_per_worker,
+        )
+        if trace_memory:
+            tracemalloc.start()
+        started_at = time.perf_counter()
+        try:
+            results = sync_items(api, items, max_in_flight=max_in_flight)
+        finally:
+            seconds = time.perf_counter() - started_at
+            peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+            if trace_memory:
+                tracemalloc.stop()
+            api.close()
+
+        return BenchResult(
+            size=size,
+            seconds=seconds,
+            calls=sum(server.hiboutik.calls.values()),
+            failures=sum(1 for r in results if not r.ok),
+            peak_memory=peak_memory,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Simulated seconds per call"
+    )
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument(
+        "--rate", type=float, default=1e6, help="Client requests per second"
+    )
+    parser.add_argument(
+        "--session-per-worker",
+        action="store_true",
+        help="Give each worker its own HTTP session",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Do not trace memory, which slows the sync down",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'items':>8} {'seconds':>9} {'items/s':>9} {'calls/item':>11}"
+        f" {'failures':>9} {'peak MiB':>9}"
+    )
+    for size in args.sizes:
+        result = run(
+            size,
+            latency=args.latency,
+            max_in_flight=args.max_in_flight,
+            rate=args.rate,
+            trace_memory=not args.no_memory,
+            session_per_worker=args.session_per_worker,
+        )
+        print(
+            f"{result.size:>8} {result.seconds:>9.2f} {result.items_per_second:>9.1f}"
+            f" {result.calls_per_item:>11.2f} {result.failures:>9}"
+            f" {result.peak_memory / 2 ** 20:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
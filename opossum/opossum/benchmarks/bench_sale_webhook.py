@@ -0,0 +1,201 @@
+"""Benchmark of the sale webhook ingestion, stage by stage.
+
+Replays synthetic Hiboutik sale payloads through the stages of the
+processing of a received sale: payload parsing, item code resolution, opening
+entry lookup and POS Invoice creation. Reports p50/p95/p99 latencies and the mean
+number of database queries of each stage.
+
+The full benchmark needs a site with items synced to Hiboutik, and creates
+real POS Invoices, so run it on a test site:
+
+    bench --site test_site execute opossum.opossum.benchmarks.bench_sale_webhook.run --kwargs "{'lines': [1, 10, 100, 500]}"
+
+The parsing stage alone runs without Frappe:
+
+    python -m opossum.opossum.benchmarks.bench_sale_webhook --lines 1 10 100 500
+"""
+import argparse
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+
+from opossum.opossum.doctype.hiboutik_settings.utils import (
+    convert_payload_to_POS_invoice,
+)
+
+DEFAULT_LINES = (1, 10, 100, 500)
+DEFAULT_REPEAT = 20
+
+PARSE, RESOLVE, OPENING_ENTRY, INVOICE = "parse", "resolve", "opening_entry", "invoice"
+
+
+def make_payload(product_ids: List[str], lines: int, rand: random.Random) -> dict:
+    """A sale form as posted by Hiboutik, with the usual fields of each line."""
+    payload = {
+        "sale_id": str(rand.randint(1, 10 ** 9)),
+        "completed_at": "2021-09-27 15:06:34",
+        "store_id": "1",
+        "vendor_id": "1",
+        "total": "0",
+    }
+    for i in range(lines):
+        line = {
+            "product_id": rand.choice(product_ids),
+            "quantity": str(rand.randint(1, 5)),
+            "product_price": f"{rand.randint(1, 100)}.00",
+            "tax_value": "0.055",
+            "discount": "0.00",
+            "product_size": "0",
+            "product_model": f"Product {i}",
+            "product_barcode": "",
+            "serial_number": "",
+            "product_comments": "",
+        }
+        for field, value in line.items():
+            payload[f"line_items[{i}][{field}]"] = value
+    return payload
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile, `q` between 0 and 100."""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+class StageRecorder:
+    """Collects the duration and the number of queries of each run of each stage."""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.queries: Dict[str, List[int]] = defaultdict(list)
+        self.query_count = 0
+
+    @contextmanager
+    def count_queries(self, db):
+        """Counts the queries sent through `db.sql` while active."""
+        sql = db.sql
+
+        def counting_sql(*args, **kwargs):
+            self.query_count += 1
+            return sql(*args, **kwargs)
+
+        db.sql = counting_sql
+        try:
+            yield
+        finally:
+            db.sql = sql
+
+    @contextmanager
+    def stage(self, name: str):
+        queries_before = self.query_count
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name].append(time.perf_counter() - started_at)
+            self.queries[name].append(self.query_count - queries_before)
+
+    def report(self) -> Dict[str, dict]:
+        return {
+            name: {
+                "runs": len(durations),
+                "p50_ms": percentile(durations, 50) * 1000,
+                "p95_ms": percentile(durations, 95) * 1000,
+                "p99_ms": percentile(durations, 99) * 1000,
+                "queries": sum(self.queries[name]) / len(self.queries[name]),
+            }
+            for name, durations in self.durations.items()
+        }
+
+
+def print_report(lines: int, report: Dict[str, dict]):
+    print(f"--- {lines} line(s)")
+    print(
+        f"{'stage':>14} {'runs':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+        f" {'queries':>8}"
+    )
+    for name, stats in report.items():
+        print(
+            f"{name:>14} {stats['runs']:>5} {stats['p50_ms']:>9.2f}"
+            f" {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}"
+            f" {stats['queries']:>8.1f}"
+        )
+
+
+def run(lines=DEFAULT_LINES, repeat=DEFAULT_REPEAT, seed=0):
+    """Runs all the stages on the current site. Returns the reports by line count."""
+    import frappe
+
+    from opossum.opossum.doctype.hiboutik_settings.hiboutik_settings import (
+        resolve_and_set_item_codes,
+    )
+    from opossum.opossum.pos_utils import (
+        get_or_create_opening_entry,
+        make_pos_invoice,
+    )
+
+    frappe.set_user("Administrator")
+    hiboutik_settings = frappe.get_single("Hiboutik Settings")
+    product_ids = frappe.get_all(
+        "Item", filters={"hiboutik_id": ["is", "set"]}, pluck="hiboutik_id"
+    )
+    if not product_ids:
+        frappe.throw("No Item synced with Hiboutik to build sales from")
+
+    rand = random.Random(seed)
+    reports = {}
+    for line_count in lines:
+        recorder = StageRecorder()
+        with recorder.count_queries(frappe.db):
+            for _ in range(repeat):
+                payload = make_payload(product_ids, line_count, rand)
+                with recorder.stage(PARSE):
+                    pos_invoice = convert_payload_to_POS_invoice(payload)
+                with recorder.stage(RESOLVE):
+                    resolve_and_set_item_codes(pos_invoice)
+                with recorder.stage(OPENING_ENTRY):
+                    opening_entry, _ = get_or_create_opening_entry("Administrator")
+                with recorder.stage(INVOICE):
+                    make_pos_invoice(
+                        pos_invoice,
+                        opening_entry.company,
+                        opening_entry.pos_profile,
+                        customer=hiboutik_settings.customer,
+                        default_income_account=hiboutik_settings.income_account,
+                    )
+        reports[line_count] = recorder.report()
+        print_report(line_count, reports[line_count])
+    return reports
+
+
+def run_parse_only(lines=DEFAULT_LINES, repeat=DEFAULT_REPEAT, seed=0):
+    rand = random.Random(seed)
+    product_ids = [str(n) for n in range(1, 1000)]
+    reports = {}
+    for line_count in lines:
+        recorder = StageRecorder()
+        for _ in range(repeat):
+            payload = make_payload(product_ids, line_count, rand)
+            with recorder.stage(PARSE):
+                convert_payload_to_POS_invoice(payload)
+        reports[line_count] = recorder.report()
+        print_report(line_count, reports[line_count])
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the sale payload parsing, without Frappe"
+    )
+    parser.add_argument("--lines", type=int, nargs="+", default=DEFAULT_LINES)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    args = parser.parse_args()
+
+    run_parse_only(lines=args.lines, repeat=args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, ioCraft and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+
+import json
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_days, get_datetime, now_datetime
+
+#: Days a Hiboutik API Metrics is kept before `purge_old_snapshots` deletes it.
+SNAPSHOT_RETENTION_DAYS = 30
+
+
+class HiboutikAPIMetrics(Document):
+    pass
+
+
+def make_snapshot(metrics: dict, source: str = "") -> Document:
+    """Stores a `HiboutikMetrics.snapshot()` as a Hiboutik API Metrics document.
+    `source` tells what made the calls."""
+    endpoints = metrics["endpoints"]
+    slowest_endpoint = max(
+        endpoints, key=lambda e: endpoints[e]["latency_sum"], default=""
+    )
+    doc = frappe.get_doc(
+        {
+            "doctype": "Hiboutik API Metrics",
+            "snapshot_date": now_datetime(),
+            "since": get_datetime(metrics["since"]),
+            "source": source,
+            "total_calls": sum(e["calls"] for e in endpoints.values()),
+            "total_retries": sum(e["retries"] for e in endpoints.values()),
+            "total_seconds": sum(e["latency_sum"] for e in endpoints.values()),
+            "slowest_endpoint": slowest_endpoint,
+            "metrics": json.dumps(metrics, indent=1),
+        }
+    )
+    doc.insert(ignore_permissions=True)
+    return doc
+
+
+def purge_old_snapshots():
+    """Scheduled daily: deletes the snapshots older than `SNAPSHOT_RETENTION_DAYS`.
+    Background syncs store one at each of their jobs."""
+    frappe.db.delete(
+        "Hiboutik API Metrics",
+        {"snapshot_date": ["<", add_days(now_datetime(), -SNAPSHOT_RETENTION_DAYS)]},
+    )
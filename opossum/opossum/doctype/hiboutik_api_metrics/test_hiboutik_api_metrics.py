@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, ioCraft and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+import frappe
+from frappe.utils import add_days, now_datetime
+from opossum.opossum.metrics import HiboutikMetrics
+
+from .hiboutik_api_metrics import (
+    SNAPSHOT_RETENTION_DAYS,
+    make_snapshot,
+    purge_old_snapshots,
+)
+
+
+class TestHiboutikAPIMetrics(unittest.TestCase):
+    def test_make_snapshot(self):
+        metrics = HiboutikMetrics()
+        metrics.record("GET products", 200, 0.5, bytes_received=1000)
+        metrics.record("PUT product/{product_id}", 200, 0.1)
+        metrics.record("PUT product/{product_id}", 429, 0.1)
+        metrics.record_retry("PUT product/{product_id}")
+
+        doc = make_snapshot(metrics.snapshot())
+
+        assert doc.total_calls == 3
+        assert doc.total_retries == 1
+        assert doc.slowest_endpoint == "GET products"
+        assert "GET products" in json.loads(doc.metrics)["endpoints"]
+        frappe.delete_doc("Hiboutik API Metrics", doc.name)
+
+    def test_old_snapshots_are_purged(self):
+        old = make_snapshot(HiboutikMetrics().snapshot())
+        old.db_set(
+            "snapshot_date", add_days(now_datetime(), -SNAPSHOT_RETENTION_DAYS - 1)
+        )
+        recent = make_snapshot(HiboutikMetrics().snapshot())
+
+        purge_old_snapshots()
+
+        assert not frappe.db.exists("Hiboutik API Metrics", old.name)
+        assert frappe.db.exists("Hiboutik API Metrics", recent.name)
+        frappe.delete_doc("Hiboutik API Metrics", recent.name)
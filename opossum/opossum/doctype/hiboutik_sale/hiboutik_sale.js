@@ -0,0 +1,8 @@
+// Copyright (c) 2021, ioCraft and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Hiboutik Sale', {
+	// refresh: function(frm) {
+
+	// }
+});
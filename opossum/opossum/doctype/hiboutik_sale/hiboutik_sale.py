@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, ioCraft and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+
+import json
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now_datetime
+
+
+class HiboutikSale(Document):
+    """An entry of the inbox of the sales received from Hiboutik, turned into a
+    POS Invoice in background"""
+
+    def get_payload(self) -> dict:
+        return json.loads(self.payload)
+
+
+def get_received_sale(sale_id) -> str or None:
+    """Returns the name of the Hiboutik Sale of this Hiboutik sale ID, if received"""
+    if not sale_id:
+        return None
+    return frappe.db.get_value("Hiboutik Sale", {"sale_id": sale_id})
+
+
+def make_sale(payload: dict) -> Document:
+    """Stores a sale posted by the Hiboutik webhook, to be processed later"""
+    doc = frappe.get_doc(
+        {
+            "doctype": "Hiboutik Sale",
+            "sale_id": payload.get("sale_id"),
+            "status": "Pending",
+            "received_at": now_datetime(),
+            "payload": json.dumps(payload, indent=1),
+        }
+    )
+    doc.insert(ignore_permissions=True)
+    return doc
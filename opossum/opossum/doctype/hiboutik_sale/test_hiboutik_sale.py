@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, ioCraft and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import unittest
+
+import frappe
+
+from .hiboutik_sale import get_received_sale, make_sale
+
+
+class TestHiboutikSale(unittest.TestCase):
+    def setUp(self):
+        frappe.db.delete("Hiboutik Sale")
+
+    def test_make_sale(self):
+        payload = {"sale_id": "12", "line_items[0][product_id]": "3"}
+
+        doc = make_sale(payload)
+
+        assert doc.status == "Pending"
+        assert doc.sale_id == "12"
+        assert doc.get_payload() == payload
+        frappe.delete_doc("Hiboutik Sale", doc.name)
+
+    def test_sale_id_is_unique(self):
+        doc = make_sale({"sale_id": "13"})
+
+        assert get_received_sale("13") == doc.name
+        with self.assertRaises(frappe.UniqueValidationError):
+            make_sale({"sale_id": "13"})
+        frappe.delete_doc("Hiboutik Sale", doc.name)
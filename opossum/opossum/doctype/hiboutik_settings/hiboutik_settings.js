@@ -2,25 +2,79 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('Hiboutik Settings', {
+	setup: function(frm) {
+		frappe.realtime.on("hiboutik_sync_progress", (progress) => {
+			show_sync_progress(frm, progress);
+		});
+	},
+
 	refresh: function(frm) {
-      cur_frm.add_custom_button(__("Sync all items"), function() {
-				  frappe.call({
-						  type:"POST",
-						  method:"opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.sync_all_items",
-              args: {
-					        json_doc: frm.doc
-				      },
-				  }).done(() => {
-						  frappe.show_alert({
-							    indicator: "green",
-							    message: __("All items synched to Hiboutik")
-						  });
-				  }).fail(() => {
-						  frappe.show_alert({
-							    indicator: "red",
-							    message: __("Items failed to synchronize to Hiboutik")
-						  });
-				  });
-      });
-	 }
+		frm.add_custom_button(__("Sync all items"), function() {
+			start_sync(frm, false);
+		});
+		frm.add_custom_button(__("Sync modified items"), function() {
+			start_sync(frm, true);
+		});
+		frm.add_custom_button(__("Cancel sync"), function() {
+			frappe.call({
+				type: "POST",
+				method: "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.cancel_sync_all_items",
+			}).done(() => {
+				frappe.show_alert(__("The sync will stop after the current batch of items"));
+			});
+		});
+	}
 });
+
+function start_sync(frm, only_modified) {
+	frappe.call({
+		type: "POST",
+		method: "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.sync_all_items",
+		args: {
+			only_modified: only_modified ? 1 : 0
+		},
+	}).done((r) => {
+		frappe.show_alert({
+			indicator: "blue",
+			message: r.message
+				? __("Synchronizing {0} items to Hiboutik in background", [r.message])
+				: __("No item to synchronize to Hiboutik")
+		});
+	}).fail(() => {
+		frappe.show_alert({
+			indicator: "red",
+			message: __("Items failed to synchronize to Hiboutik")
+		});
+	});
+}
+
+function show_sync_progress(frm, progress) {
+	const finished = progress.cancelled || progress.done >= progress.total;
+	if (!finished) {
+		frm.dashboard.show_progress(
+			__("Hiboutik sync"),
+			progress.done / progress.total * 100,
+			__("{0} of {1} items synchronized", [progress.done, progress.total])
+		);
+		return;
+	}
+
+	frm.dashboard.hide_progress(__("Hiboutik sync"));
+	if (progress.cancelled) {
+		frappe.show_alert({
+			indicator: "orange",
+			message: __("Sync cancelled after {0} of {1} items", [progress.done, progress.total])
+		});
+	} else if (progress.failed.length) {
+		frappe.show_alert({
+			indicator: "red",
+			message: __("Items failed to synchronize to Hiboutik: {0}", [progress.failed.join(", ")])
+		});
+	} else {
+		frm.reload_doc();
+		frappe.show_alert({
+			indicator: "green",
+			message: __("All items synched to Hiboutik")
+		});
+	}
+}
@@ -8,22 +8,78 @@
 from __future__ import unicode_literals
 
 import json
+import time
+from contextlib import contextmanager
+from copy import copy
+from typing import Dict, List, Optional
 
 import frappe
 from erpnext.utilities.product import get_price
 from frappe import _
 from frappe.custom.doctype.custom_field.custom_field import create_custom_field
 from frappe.model.document import Document
-from frappe.utils import flt
+from frappe.utils import cint, flt, now_datetime
 from opossum.opossum import hiboutik
+from opossum.opossum.doctype.hiboutik_api_metrics.hiboutik_api_metrics import (
+    make_snapshot,
+)
+from opossum.opossum.doctype.hiboutik_sale.hiboutik_sale import (
+    get_received_sale,
+    make_sale,
+)
 from opossum.opossum.doctype.hiboutik_settings.utils import convert_payload_to_POS_invoice
-from opossum.opossum.hiboutik import HiboutikAPI, HiboutikAPIError, HiboutikConnector
+from opossum.opossum.doctype.hiboutik_sync_run.hiboutik_sync_run import (
+    get_running_sync_run,
+    make_sync_run,
+)
+from opossum.opossum.hiboutik import (
+    HiboutikAPI,
+    HiboutikAPIError,
+    HiboutikConnector,
+    HiboutikTimeoutError,
+    HiboutikUnavailableError,
+    ProductCatalog,
+    is_up_to_date,
+)
+from opossum.opossum.hiboutik_async import DEFAULT_MAX_IN_FLIGHT, sync_items
 from opossum.opossum.models import Item, POSInvoice
+from opossum.opossum.throttling import DEFAULT_RATE, Deadline
 from opossum.opossum.pos_utils import get_or_create_opening_entry, make_pos_invoice
 from six import string_types
 from six.moves.urllib.parse import urlparse
 
 
+#: Seconds a web request may spend talking to Hiboutik for a single operation.
+HIBOUTIK_OPERATION_DEADLINE = 30
+
+#: Cache hash of the items queued for sync by their code, with their last change time.
+PENDING_SYNC_CACHE_KEY = "hiboutik_pending_item_syncs"
+
+#: Seconds an item must stay unchanged before its queued sync is run.
+PENDING_SYNC_DEBOUNCE = 30
+
+#: Number of items synced by each background job of `sync_all_items`.
+SYNC_CHUNK_SIZE = 200
+
+#: Name of the database lock held by the job syncing a chunk of a Hiboutik Sync Run.
+SYNC_RUN_LOCK = "hiboutik_sync_run:{run}"
+
+#: Cache key of the Hiboutik catalog shared by the chunks of a Hiboutik Sync Run.
+SYNC_CATALOG_CACHE_KEY = "hiboutik_sync_catalog:{run}"
+#: Seconds the catalog of a run stays in cache, should the run die.
+SYNC_CATALOG_EXPIRY = 6 * 60 * 60
+
+#: Outside of a Hiboutik Sync Run, number of changed items from which the whole
+#: catalog is loaded rather than each product fetched on its own.
+CATALOG_LOAD_MIN_ITEMS = 50
+
+#: Number of Hiboutik Sales invoiced per database transaction.
+SALE_BATCH_SIZE = 50
+SALE_SAVEPOINT = "hiboutik_sale"
+#: Name of the database lock held by the job processing the pending sales.
+SALE_LOCK = "hiboutik_pending_sales"
+
+
 class HiboutikSettings(Document):
     def validate(self):
         self.validate_settings()
@@ -72,6 +128,16 @@ class HiboutikSettings(Document):
                         print_hide=1,
                         translatable=0,
                     ),
+                    dict(
+                        fieldname="hiboutik_fingerprint",
+                        label="Hiboutik Fingerprint",
+                        fieldtype="Data",
+                        read_only=1,
+                        hidden=1,
+                        print_hide=1,
+                        translatable=0,
+                        no_copy=1,
+                    ),
                     dict(
                         fieldname="sync_with_hiboutik",
                         label="Sync with Hiboutik",
@@ -104,11 +170,7 @@ class HiboutikSettings(Document):
         if self.enable_sync:
             self.pos_invoice_webhook = self._make_pos_invoice_webhook_url()
 
-            hiboutik_api = HiboutikAPI(
-                account=self.instance_name,
-                user=self.username,
-                api_key=self.api_key,
-            )
+            hiboutik_api = get_hiboutik_api_from_settings(self)
 
             connector = HiboutikConnector(hiboutik_api)
 
@@ -116,7 +178,14 @@ class HiboutikSettings(Document):
                 self.pos_invoice_webhook
             )
             try:
-                connector.set_sale_webhook(webhook)
+                with Deadline(HIBOUTIK_OPERATION_DEADLINE):
+                    connector.set_sale_webhook(webhook)
+            except (HiboutikTimeoutError, HiboutikUnavailableError):
+                frappe.msgprint(
+                    msg="Hiboutik est injoignable, le Webhook n'a pas pu être mis en place. Réessayez plus tard.",
+                    title="Erreur Hiboutik",
+                    raise_exception=HiboutikAPIError,
+                )
             except HiboutikAPIError as e:
                 frappe.msgprint(
                     msg="Erreur de mise en place du Webhook. Vérifiez que vous avez les droits dans l'interface Hiboutik.",
@@ -125,29 +194,417 @@ class HiboutikSettings(Document):
                 )
 
 
+def get_hiboutik_api_from_settings(hb_settings: Document) -> HiboutikAPI:
+    """Returns the process-wide pooled client, rebuilt whenever the settings change.
+    Its concurrency and request rate are bounded as set in the settings."""
+    concurrency = cint(hb_settings.max_concurrent_requests) or DEFAULT_MAX_IN_FLIGHT
+    return hiboutik.get_hiboutik_api(
+        account=hb_settings.instance_name,
+        user=hb_settings.username,
+        api_key=hb_settings.api_key,
+        version=str(hb_settings.modified),
+        pool_maxsize=concurrency,
+        rate=flt(hb_settings.max_requests_per_second) or DEFAULT_RATE,
+        max_concurrency=concurrency,
+    )
+
+
 @frappe.whitelist()
-def sync_all_items():
-    """Synchronize all items where 'hiboutik_sync' checkbox is ticked"""
+def sync_all_items(only_modified=False):
+    """Synchronize all items where 'hiboutik_sync' checkbox is ticked.
+
+    With `only_modified`, only the items whose Item, Item Price or stock changed
+    since the last successful sync are synchronized.
+
+    The sync runs in background jobs of `SYNC_CHUNK_SIZE` items each, reporting
+    their progress with the `hiboutik_sync_progress` realtime event. Each chunk
+    is checkpointed in a Hiboutik Sync Run: a run which died is resumed where it
+    stopped rather than started over. Returns the number of items to sync."""
 
     hiboutik_settings = frappe.get_doc("Hiboutik Settings")
 
     if not hiboutik_settings.enable_sync:
         return False
 
-    items = frappe.db.get_list(
-        "Item",
-        filters={"sync_with_hiboutik": "1", "disabled": "false"},
-        fields=["item_code"],
+    run = get_running_sync_run()
+    if run and not run.is_stale:
+        frappe.throw(_("A sync of all items is already running: {0}").format(run.name))
+    if run:
+        _enqueue_sync_chunk(run.name)
+        return run.total_items - run.done_items
+
+    started_at = now_datetime()
+
+    filters = {"sync_with_hiboutik": "1", "disabled": "false"}
+    watermark = hiboutik_settings.last_sync_watermark
+    if cint(only_modified) and watermark:
+        item_codes = get_item_codes_modified_since(watermark, hiboutik_settings)
+        if not item_codes:
+            return 0
+        filters["item_code"] = ["in", list(item_codes)]
+
+    item_codes = frappe.db.get_list("Item", filters=filters, pluck="item_code")
+
+    run = make_sync_run(
+        item_codes, cint(only_modified), started_at, frappe.session.user
     )
+    _enqueue_sync_chunk(run.name)
+    return len(item_codes)
+
+
+@frappe.whitelist()
+def cancel_sync_all_items():
+    """Stops the running sync of all items once its current chunk is done"""
+    run = get_running_sync_run()
+    if run:
+        run.db_set("status", "Cancelled")
+
+
+def resume_stale_sync_runs():
+    """Scheduled hourly: resumes the sync of all items if its jobs died"""
+    run = get_running_sync_run()
+    if run and run.is_stale:
+        _enqueue_sync_chunk(run.name)
+
+
+def _enqueue_sync_chunk(run: str):
+    frappe.enqueue(
+        "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.sync_items_chunk",
+        queue="long",
+        run=run,
+    )
+
+
+def sync_items_chunk(run: str):
+    """Background job syncing the next chunk of items of a Hiboutik Sync Run, then
+    enqueuing the following one.
+
+    The chunk is checkpointed as in flight before it is synced. If it still is
+    when the job starts, the previous attempt died in the middle of it: products
+    it created without storing their Hiboutik ID are adopted instead of being
+    created twice.
+
+    A single job of a run syncs at a time. A run resumed twice, e.g. by the user
+    and by `resume_stale_sync_runs`, has a job returning at once, leaving the run
+    to the other one."""
+    lock = SYNC_RUN_LOCK.format(run=run)
+    # GET_LOCK is MariaDB/MySQL only, as is the rest of the app's SQL
+    if not frappe.db.sql("select get_lock(%s, 0)", (lock,))[0][0]:
+        return
+    try:
+        # Read the run as left by the job which held the lock
+        frappe.db.commit()
+        _sync_next_chunk(run)
+    finally:
+        frappe.db.sql("select release_lock(%s)", (lock,))
+
+
+def _sync_next_chunk(run: str):
+    run = frappe.get_doc("Hiboutik Sync Run", run)
+    if run.status != "Running":
+        _publish_sync_progress(run)
+        return
+
+    item_codes = run.get_item_codes()
+    chunk = item_codes[run.done_items : run.done_items + SYNC_CHUNK_SIZE]
+    interrupted = bool(run.get_in_flight_items())
+    run.checkpoint(in_flight_items=chunk)
 
-    for item in items:
-        res = _sync_item_to_hiboutik(item["item_code"])
-        if not res:
-            frappe.msgprint(
-                msg=f"Erreur de synchronization de l'item {item.code}." % item,
-                title="Erreur Hiboutik",
-                raise_exception=HiboutikAPIError,
+    hiboutik_settings = frappe.get_single("Hiboutik Settings")
+    source = f"{run.name}, {run.done_items + len(chunk)}/{len(item_codes)}"
+    try:
+        with _storing_metrics(hiboutik_settings, source):
+            failed = _sync_item_codes(
+                chunk, hiboutik_settings, adopt_orphans=interrupted, run=run.name
             )
+    except (Exception, HiboutikAPIError):
+        frappe.log_error(frappe.get_traceback(), "Erreur Hiboutik")
+        failed = chunk
+
+    failed = run.get_failed_items() + failed
+    done = run.done_items + len(chunk)
+    # Cancelling only changes the status, which must not be overwritten
+    run.status = frappe.db.get_value("Hiboutik Sync Run", run.name, "status")
+    if run.status == "Running" and done == len(item_codes):
+        run.status = "Failed" if failed else "Completed"
+    run.checkpoint(
+        status=run.status, done_items=done, failed_items=failed, in_flight_items=[]
+    )
+    _publish_sync_progress(run)
+
+    if run.status != "Running":
+        frappe.cache().delete_value(SYNC_CATALOG_CACHE_KEY.format(run=run.name))
+
+    if run.status == "Running":
+        _enqueue_sync_chunk(run.name)
+    elif run.status == "Failed":
+        frappe.log_error(
+            f"Erreur de synchronization des items {', '.join(failed)}.",
+            "Erreur Hiboutik",
+        )
+    elif run.status == "Completed":
+        # Not bumping `modified`, which would rebuild the Hiboutik client
+        frappe.db.set_value(
+            "Hiboutik Settings",
+            None,
+            "last_sync_watermark",
+            run.started_at,
+            update_modified=False,
+        )
+
+
+def _publish_sync_progress(run: Document):
+    frappe.publish_realtime(
+        "hiboutik_sync_progress",
+        dict(
+            run=run.name,
+            done=run.done_items,
+            total=run.total_items,
+            failed=run.get_failed_items(),
+            cancelled=run.status == "Cancelled",
+        ),
+        user=run.user,
+        after_commit=True,
+    )
+
+
+def get_item_codes_modified_since(watermark, hiboutik_settings: Document) -> set:
+    """Returns the codes of the Items which, or whose price in the POS price list
+    or stock in the POS warehouse, were modified after `watermark`.
+
+    The variants of the Items whose price was modified are returned too. Stock
+    moves are read from the Stock Ledger Entries: they don't always bump the
+    `modified` of the Bin they update."""
+    pos_profile = frappe.get_doc("POS Profile", hiboutik_settings.pos_profile)
+    modified = ["modified", ">", watermark]
+
+    item_codes = set(frappe.get_all("Item", filters=[modified], pluck="item_code"))
+    priced_item_codes = frappe.get_all(
+        "Item Price",
+        filters=[modified, ["price_list", "=", pos_profile.selling_price_list]],
+        pluck="item_code",
+    )
+    item_codes.update(priced_item_codes)
+    # Variants without a price of their own take their template's one
+    item_codes.update(_get_variant_codes(priced_item_codes))
+    item_codes.update(
+        frappe.get_all(
+            "Stock Ledger Entry",
+            filters=[
+                ["creation", ">", watermark],
+                ["warehouse", "=", pos_profile.warehouse],
+            ],
+            pluck="item_code",
+            distinct=True,
+        )
+    )
+    return item_codes
+
+
+def _sync_item_codes(
+    item_codes: List[str],
+    hiboutik_settings: Document,
+    adopt_orphans=False,
+    run: str = None,
+) -> List[str]:
+    """Syncs the given Items concurrently. Returns the codes of those which failed.
+
+    With `adopt_orphans`, an item without Hiboutik ID takes over the product
+    named as it and linked to no item, if any, instead of creating one.
+
+    The chunks of a Hiboutik Sync Run `run` share the Hiboutik catalog, loaded
+    by the first one needing it and kept in cache for the next ones, but for the
+    products whose stock is managed. Outside of
+    a run, the catalog is only loaded for `CATALOG_LOAD_MIN_ITEMS` changed items
+    or more."""
+    hiboutik_api = get_hiboutik_api_from_settings(hiboutik_settings)
+    catalog = None
+
+    failed = []
+    to_sync = []
+    items = _make_items(item_codes, hiboutik_settings)
+    if adopt_orphans:
+        # The cached catalog misses the products created by the interrupted chunk
+        catalog = ProductCatalog.load(hiboutik_api)
+    else:
+        changed_items = [i for i in items.values() if i and not is_up_to_date(i)]
+        if run and changed_items:
+            catalog = _get_run_catalog(run, hiboutik_api)
+        elif len(changed_items) < CATALOG_LOAD_MIN_ITEMS:
+            # Products missing from the catalog are fetched one by one
+            catalog = ProductCatalog()
+    if adopt_orphans:
+        linked_ids = set(
+            frappe.get_all(
+                "Item", filters={"hiboutik_id": ["is", "set"]}, pluck="hiboutik_id"
+            )
+        )
+    for item_code, item in items.items():
+        if item is None:
+            failed.append(item_code)
+            continue
+        stored_item = copy(item)
+        if adopt_orphans and not item.external_id:
+            orphan = catalog.find_orphan(item, linked_ids)
+            if orphan is not None:
+                item.external_id = str(orphan.product_id)
+                linked_ids.add(item.external_id)
+        to_sync.append((stored_item, item))
+
+    def save_results(results):
+        for (stored_item, _), result in zip(to_sync, results):
+            if result.ok:
+                _save_synced_item(stored_item, result.item)
+                continue
+            failed.append(stored_item.code)
+            if result.item.external_id != stored_item.external_id:
+                # Created before the failure: keep its ID, or it would be created
+                # again. The fingerprint is left for the item to be diffed again.
+                half_synced_item = copy(stored_item)
+                half_synced_item.external_id = result.item.external_id
+                _save_synced_item(stored_item, half_synced_item)
+
+    try:
+        sync_items(
+            hiboutik_api,
+            [item for _, item in to_sync],
+            max_in_flight=cint(hiboutik_settings.max_concurrent_requests)
+            or DEFAULT_MAX_IN_FLIGHT,
+            item_deadline=HIBOUTIK_OPERATION_DEADLINE,
+            on_synced=save_results,
+            catalog=catalog,
+        )
+    finally:
+        if run and catalog is not None:
+            # Kept up to date by the sync with its own writes. The stocked products
+            # are fetched again by each chunk, their stock may have moved since.
+            frappe.cache().set_value(
+                SYNC_CATALOG_CACHE_KEY.format(run=run),
+                catalog.to_data(stocked=False),
+                expires_in_sec=SYNC_CATALOG_EXPIRY,
+            )
+
+    return failed
+
+
+def _get_run_catalog(run: str, hiboutik_api: HiboutikAPI) -> ProductCatalog:
+    data = frappe.cache().get_value(SYNC_CATALOG_CACHE_KEY.format(run=run))
+    if data is None:
+        return ProductCatalog.load(hiboutik_api)
+    return ProductCatalog.from_data(data)
+
+
+def mark_item_for_sync(doc: Document, method=None):
+    """doc_events handler of Item, Item Price, Bin and Stock Ledger Entry.
+
+    Queues the sync of the changed item. Repeated changes of an item only keep
+    the time of the last one, the item is synced once it settled down."""
+    if not cint(frappe.db.get_single_value("Hiboutik Settings", "enable_sync")):
+        return
+    if doc.doctype == "Item" and not doc.get("sync_with_hiboutik"):
+        return
+    item_codes = [doc.item_code]
+    if doc.doctype == "Item Price":
+        # Variants without a price of their own take their template's one
+        item_codes += _get_variant_codes(item_codes)
+    _queue_item_syncs(item_codes)
+
+
+def _get_variant_codes(item_codes: List[str]) -> List[str]:
+    if not item_codes:
+        return []
+    return frappe.get_all(
+        "Item", filters={"variant_of": ["in", list(item_codes)]}, pluck="item_code"
+    )
+
+
+def _queue_item_syncs(item_codes: List[str]):
+    cache = frappe.cache()
+    changed_at = time.time()
+    for item_code in item_codes:
+        cache.hset(PENDING_SYNC_CACHE_KEY, item_code, changed_at)
+
+
+def enqueue_pending_item_syncs():
+    """Scheduled every minute: enqueues the sync of all the queued items left
+    unchanged for `PENDING_SYNC_DEBOUNCE` seconds"""
+    cache = frappe.cache()
+    settled_before = time.time() - PENDING_SYNC_DEBOUNCE
+    item_codes = [
+        frappe.safe_decode(item_code)
+        for item_code, changed_at in cache.hgetall(PENDING_SYNC_CACHE_KEY).items()
+        if changed_at <= settled_before
+    ]
+    if not item_codes:
+        return
+
+    for item_code in item_codes:
+        cache.hdel(PENDING_SYNC_CACHE_KEY, item_code)
+
+    _enqueue_queued_items(item_codes)
+
+
+def _enqueue_queued_items(item_codes: List[str]):
+    frappe.enqueue(
+        "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.sync_queued_items",
+        queue="long",
+        item_codes=item_codes,
+    )
+
+
+def sync_queued_items(item_codes: List[str]):
+    """Background job syncing the queued items which are still to be synced.
+
+    The job syncs `SYNC_CHUNK_SIZE` items, then enqueues the job of the next ones.
+    Items that the running sync of all items is syncing are queued again, and
+    those it has still to sync are left to it, so that both don't create the same
+    product. If the chunk can't be synced at all, its items are queued again."""
+    hiboutik_settings = frappe.get_single("Hiboutik Settings")
+
+    if not hiboutik_settings.enable_sync:
+        return
+
+    chunk, next_item_codes = item_codes[:SYNC_CHUNK_SIZE], item_codes[SYNC_CHUNK_SIZE:]
+    try:
+        _sync_queued_chunk(chunk, hiboutik_settings)
+    finally:
+        if next_item_codes:
+            _enqueue_queued_items(next_item_codes)
+
+
+def _sync_queued_chunk(item_codes: List[str], hiboutik_settings: Document):
+    run = get_running_sync_run()
+    if run and not run.is_stale:
+        in_flight = set(run.get_in_flight_items())
+        left_to_run = set(run.get_item_codes()[run.done_items :])
+        _queue_item_syncs([code for code in item_codes if code in in_flight])
+        item_codes = [code for code in item_codes if code not in left_to_run]
+
+    if not item_codes:
+        return
+
+    item_codes = frappe.get_all(
+        "Item",
+        filters={
+            "item_code": ["in", item_codes],
+            "sync_with_hiboutik": 1,
+            "disabled": 0,
+        },
+        pluck="item_code",
+    )
+
+    try:
+        with _storing_metrics(hiboutik_settings, "sync_queued_items"):
+            failed = _sync_item_codes(item_codes, hiboutik_settings)
+    except (Exception, HiboutikAPIError):
+        _queue_item_syncs(item_codes)
+        raise
+
+    if failed:
+        frappe.log_error(
+            f"Erreur de synchronization des items {', '.join(failed)}.",
+            "Erreur Hiboutik",
+        )
 
 
 @frappe.whitelist()
@@ -176,96 +633,326 @@ def _sync_item_to_hiboutik(item_code: str):
             title="Erreur de configuration",
         )
 
-    # Get POS Profile from Hiboutik Settings
     hiboutik_settings = frappe.get_single("Hiboutik Settings")
-    pos_profile = frappe.get_doc("POS Profile", hiboutik_settings.pos_profile)
 
-    hb_tax_id = get_hiboutik_tax_id(item_doc, hiboutik_settings)
+    item = _make_items([item_code], hiboutik_settings)[item_code]
+    if item is None:
+        frappe.msgprint("Quantité en stock non trouvée !")
+        return
+    stored_item = copy(item)
+    # Syncing a single item is explicit: check it against Hiboutik anyway
+    item.fingerprint = ""
+
+    hiboutik_api = get_hiboutik_api_from_settings(hiboutik_settings)
+
+    connector = HiboutikConnector(hiboutik_api)
 
-    # Get Price given the Price List configured
-    price = get_price(
-        item_doc.item_code,
-        pos_profile.selling_price_list,
-        "",  # Customer_group
-        pos_profile.company,
-        qty=1,
+    with Deadline(HIBOUTIK_OPERATION_DEADLINE):
+        updated_item = connector.sync(item)
+
+    _save_synced_item(stored_item, updated_item)
+
+    return True
+
+
+def _make_items(
+    item_codes: List[str], hiboutik_settings: Document
+) -> Dict[str, Optional[Item]]:
+    """Builds the proxy Items to sync from the ERPNext Items, by item code, with a
+    handful of queries for the whole batch. A stocked item is None if its stock
+    quantity can't be found."""
+    if not item_codes:
+        return {}
+
+    pos_profile = frappe.get_cached_doc("POS Profile", hiboutik_settings.pos_profile)
+
+    fields = [
+        "name",
+        "item_code",
+        "item_group",
+        "variant_of",
+        "is_stock_item",
+        "hiboutik_id",
+    ]
+    if frappe.get_meta("Item").has_field("hiboutik_fingerprint"):
+        fields.append("hiboutik_fingerprint")
+    item_rows = frappe.get_all(
+        "Item", filters={"item_code": ["in", item_codes]}, fields=fields
     )
 
-    item = Item(
-        code=item_doc.item_code,
-        name=item_doc.name,
-        external_id=item_doc.hiboutik_id,
-        price=flt(price.get("price_list_rate") if price else 0.0),
-        vat=hb_tax_id,
-        is_stock_item=item_doc.is_stock_item,
+    tax_templates = _get_tax_templates("Item", [row.item_code for row in item_rows])
+    group_tax_templates = _get_tax_templates(
+        "Item Group", list({row.item_group for row in item_rows})
+    )
+    templates = {row.item_code: row.variant_of for row in item_rows if row.variant_of}
+    prices = _get_prices(
+        [row.item_code for row in item_rows], pos_profile, templates=templates
+    )
+    stock_qties = _get_stock_qties(
+        [row.item_code for row in item_rows if row.is_stock_item], pos_profile
     )
 
-    # frappe.msgprint(msg=item.is_stock_item)
-
-    # If stocked item, fill in quantity from warehouse
-    if item.is_stock_item:
-        bins = frappe.db.get_all('Bin', fields=['item_code', 'warehouse', 'projected_qty',
-			                                    'reserved_qty', 'reserved_qty_for_production',
-                                                'reserved_qty_for_sub_contract', 'actual_qty', 'valuation_rate'],
-		                         filters=[
-                                     ['item_code', '=', item.code],
-                                     ['warehouse', '=', pos_profile.warehouse]
-                                 ])
-
-        # get the first warehouse
-        if len(bins):
-            bin = bins[0]
-        else:
-            frappe.msgprint("Quantité en stock non trouvée !")
-            return
+    items = {}
+    for row in item_rows:
+        itt_name = (
+            tax_templates.get(row.item_code)
+            or group_tax_templates.get(row.item_group)
+            or ""
+        )
+        item = Item(
+            code=row.item_code,
+            name=row.name,
+            external_id=row.hiboutik_id or "",
+            fingerprint=row.get("hiboutik_fingerprint") or "",
+            price=flt(prices.get(row.item_code)),
+            vat=get_hiboutik_tax_id_from_template(itt_name, hiboutik_settings),
+            is_stock_item=row.is_stock_item,
+        )
+        if item.is_stock_item:
+            if row.item_code not in stock_qties:
+                items[row.item_code] = None
+                continue
+            item.stock_qty = stock_qties[row.item_code]
+        items[row.item_code] = item
+    return items
+
+
+def _get_tax_templates(parenttype: str, parents: List[str]) -> Dict[str, str]:
+    """Returns the first Item Tax Template of each Item or Item Group"""
+    if not parents:
+        return {}
+    rows = frappe.get_all(
+        "Item Tax",
+        filters={"parenttype": parenttype, "parent": ["in", parents]},
+        fields=["parent", "item_tax_template"],
+        order_by="idx asc",
+    )
+    rv = {}
+    for row in rows:
+        rv.setdefault(row.parent, row.item_tax_template)
+    return rv
+
+
+def _get_prices(
+    item_codes: List[str], pos_profile: Document, templates: Dict[str, str] = None
+) -> Dict[str, float]:
+    """Returns the rate of each item in the POS price list.
+
+    As `get_price` does, a variant without a price of its own gets the price of
+    its template, given by `templates` (item code -> template code).
+
+    Selling pricing rules are only applied by `get_price`, so if any is enabled,
+    it is called for each item instead of reading the Item Prices at once."""
+    if not item_codes:
+        return {}
+
+    if frappe.db.exists("Pricing Rule", {"selling": 1, "disable": 0}):
+        prices = {}
+        for item_code in item_codes:
+            price = get_price(
+                item_code,
+                pos_profile.selling_price_list,
+                "",  # Customer_group
+                pos_profile.company,
+                qty=1,
+            )
+            prices[item_code] = price.get("price_list_rate") if price else 0.0
+        return prices
+
+    templates = templates or {}
+    rows = frappe.get_all(
+        "Item Price",
+        filters={
+            "price_list": pos_profile.selling_price_list,
+            "item_code": ["in", list(set(item_codes) | set(templates.values()))],
+        },
+        fields=["item_code", "price_list_rate"],
+    )
+    rates = {}
+    for row in rows:
+        rates.setdefault(row.item_code, row.price_list_rate)
+
+    prices = {}
+    for item_code in item_codes:
+        if item_code in rates:
+            prices[item_code] = rates[item_code]
+        elif templates.get(item_code) in rates:
+            prices[item_code] = rates[templates[item_code]]
+    return prices
+
+
+def _get_stock_qties(item_codes: List[str], pos_profile: Document) -> Dict[str, float]:
+    """Returns the actual quantity of each item in the POS warehouse, if any"""
+    if not item_codes:
+        return {}
+    rows = frappe.get_all(
+        "Bin",
+        filters={"item_code": ["in", item_codes], "warehouse": pos_profile.warehouse},
+        fields=["item_code", "actual_qty"],
+    )
+    return {row.item_code: row.actual_qty for row in rows}
+
+
+def _save_synced_item(stored_item: Item, updated_item: Item):
+    """Stores back on the ERPNext Item what the sync learnt about it.
+    `stored_item` is the item as it was loaded, before the sync."""
+    changes = {}
+    if stored_item.external_id != updated_item.external_id:
+        changes["hiboutik_id"] = updated_item.external_id
+    # The field is missing until the settings are saved or the site migrated
+    has_fingerprint = frappe.get_meta("Item").has_field("hiboutik_fingerprint")
+    if stored_item.fingerprint != updated_item.fingerprint and has_fingerprint:
+        changes["hiboutik_fingerprint"] = updated_item.fingerprint
+    if changes:
+        # Not bumping `modified`, or the delta sync would pick the item again
+        frappe.db.set_value("Item", stored_item.code, changes, update_modified=False)
+
+
+@contextmanager
+def _storing_metrics(hiboutik_settings: Document, source: str):
+    """Stores the metrics of the Hiboutik calls made within the block in a Hiboutik
+    API Metrics. Background jobs run in short-lived processes, whose client
+    metrics are lost with them otherwise."""
+    metrics = get_hiboutik_api_from_settings(hiboutik_settings).metrics
+    metrics.reset()
+    try:
+        yield
+    finally:
+        snapshot = metrics.snapshot()
+        if snapshot["endpoints"]:
+            make_snapshot(snapshot, source=source)
 
-        item.stock_qty = bin['actual_qty']
 
-    hiboutik_api = HiboutikAPI(
-        account=hiboutik_settings.instance_name,
-        user=hiboutik_settings.username,
-        api_key=hiboutik_settings.api_key,
-    )
+@frappe.whitelist()
+def get_hiboutik_metrics():
+    """Returns the per-endpoint metrics of this process' Hiboutik client.
 
-    connector = HiboutikConnector(hiboutik_api)
+    Those of the syncs run in background are stored by each job as Hiboutik API
+    Metrics."""
+    frappe.only_for("System Manager")
 
-    updated_item = connector.sync(item)
+    hiboutik_settings = frappe.get_single("Hiboutik Settings")
 
-    if item_doc.hiboutik_id != updated_item.external_id:
-        item_doc.hiboutik_id = updated_item.external_id
-        item_doc.save()
-        # item_doc.reload() # XXX Can't figure out how to do it
+    return get_hiboutik_api_from_settings(hiboutik_settings).metrics.snapshot()
 
-    return True
+
+@frappe.whitelist()
+def take_hiboutik_metrics_snapshot():
+    """Stores the metrics of this process' Hiboutik client in a Hiboutik API Metrics"""
+    return make_snapshot(get_hiboutik_metrics()).name
 
 
 @frappe.whitelist(allow_guest=True)
 def pos_invoice_webhook(*args, **kwargs):
-    """Receives a POS Invoice from Hiboutik"""
+    """Receives a POS Invoice from Hiboutik.
 
-    frappe.set_user("Administrator")
+    The sale is only stored in the Hiboutik Sale inbox, and answered right away:
+    the POS Invoice is made by a background job. A sale posted again, e.g. when
+    Hiboutik retries the call, is ignored."""
 
     data = dict(frappe.request.form)
 
-    pos_invoice = convert_payload_to_POS_invoice(data)
+    received_sale = get_received_sale(data.get("sale_id"))
+    if received_sale:
+        return received_sale
+
+    try:
+        sale = make_sale(data)
+    except frappe.UniqueValidationError:
+        # Posted again while the first call was being answered
+        frappe.db.rollback()
+        return get_received_sale(data.get("sale_id"))
+
+    frappe.enqueue(
+        "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings.process_pending_sales",
+        enqueue_after_commit=True,
+    )
+
+    return sale.name
+
+
+def process_pending_sales():
+    """Background job making the POS Invoices of the pending Hiboutik Sales, oldest
+    first. Also scheduled, in case a job was lost.
+
+    Sales are processed by batches of `SALE_BATCH_SIZE` sharing their lookups and
+    a single commit. A failing sale is rolled back alone, to its savepoint.
+
+    A single job processes the sales at a time: the jobs enqueued meanwhile by
+    the webhook return at once, leaving the new sales to the running one or, if
+    it was ending, to the next scheduled run."""
+    # GET_LOCK is MariaDB/MySQL only, as is the rest of the app's SQL
+    if not frappe.db.sql("select get_lock(%s, 0)", (SALE_LOCK,))[0][0]:
+        return
+
+    frappe.set_user("Administrator")
+    try:
+        while _process_sale_batch():
+            pass
+    finally:
+        frappe.db.sql("select release_lock(%s)", (SALE_LOCK,))
+
+
+def _process_sale_batch() -> int:
+    """Processes the oldest pending sales. Returns how many were pending.
+    Must run under the `SALE_LOCK`."""
+    names = frappe.get_all(
+        "Hiboutik Sale",
+        filters={"status": "Pending"},
+        order_by="creation asc",
+        limit=SALE_BATCH_SIZE,
+        pluck="name",
+    )
+    if not names:
+        return 0
 
     opening_entry, created = get_or_create_opening_entry(
-        "Administrator"
+        "Administrator", commit=False
     )  # FIXME Hardcoded username
+    hiboutik_settings = frappe.get_single("Hiboutik Settings")
 
-    resolve_and_set_item_codes(pos_invoice)
+    pos_invoices = {}
+    for name in names:
+        sale = frappe.get_doc("Hiboutik Sale", name)
+        try:
+            pos_invoices[name] = convert_payload_to_POS_invoice(sale.get_payload())
+        except Exception:
+            _set_sale_failed(sale)
+
+    # The products of the whole batch are looked up at once
+    item_codes = get_item_codes_from_external_ids(
+        {
+            item.external_id
+            for pos_invoice in pos_invoices.values()
+            for item in pos_invoice.invoice_items
+        }
+    )
 
-    hiboutik_settings = frappe.get_doc("Hiboutik Settings")
+    for name, pos_invoice in pos_invoices.items():
+        sale = frappe.get_doc("Hiboutik Sale", name)
+        frappe.db.savepoint(SALE_SAVEPOINT)
+        try:
+            resolve_and_set_item_codes(pos_invoice, item_codes)
+            pos_invoice_doc = make_pos_invoice(
+                pos_invoice,
+                opening_entry.company,
+                opening_entry.pos_profile,
+                customer=hiboutik_settings.customer,
+                default_income_account=hiboutik_settings.income_account,
+                commit=False,
+            )
+        except Exception:
+            frappe.db.rollback(save_point=SALE_SAVEPOINT)
+            _set_sale_failed(sale)
+        else:
+            sale.db_set({"status": "Processed", "pos_invoice": pos_invoice_doc.name})
+
+    frappe.db.commit()
+    return len(names)
 
-    make_pos_invoice(
-        pos_invoice,
-        opening_entry.company,
-        opening_entry.pos_profile,
-        customer=hiboutik_settings.customer,
-        default_income_account=hiboutik_settings.income_account
-    )
 
-    # Insert a POS Invoice with update stock selected
+def _set_sale_failed(sale: Document):
+    sale.db_set({"status": "Failed", "error": frappe.get_traceback()})
 
 
 @frappe.whitelist
@@ -273,27 +960,53 @@ def pos_closing_webhook():
     pass
 
 
-def resolve_and_set_item_codes(pos_invoice: POSInvoice):
-    """Set Item Code from External id field"""
+def resolve_and_set_item_codes(
+    pos_invoice: POSInvoice, item_codes: Optional[Dict[str, str]] = None
+):
+    """Set Item Code from External id field.
+
+    `item_codes` are the codes by external ID, as returned by
+    `get_item_codes_from_external_ids`, looked up when not given. Throws with
+    all the external IDs that match no Item."""
+    if item_codes is None:
+        item_codes = get_item_codes_from_external_ids(
+            {item.external_id for item in pos_invoice.invoice_items}
+        )
+
+    unknown_ids = []
     for item in pos_invoice.invoice_items:
-        item.code = get_item_code_from_external_id(item.external_id)
+        item.code = item_codes.get(item.external_id)
+        if not item.code and item.external_id not in unknown_ids:
+            unknown_ids.append(item.external_id)
+
+    if unknown_ids:
+        frappe.throw(
+            _("No Item found for the Hiboutik products: {0}").format(
+                ", ".join(unknown_ids)
+            )
+        )
 
 
-def get_item_code_from_external_id(external_id: str):
-    """Given the Hiboutik stored external ID, retrieve the ERPNext Item code"""
-    return frappe.db.get_value("Item", dict(hiboutik_id=external_id))
+def get_item_codes_from_external_ids(external_ids) -> Dict[str, str]:
+    """The ERPNext Item codes by Hiboutik external ID, in one query"""
+    if not external_ids:
+        return {}
+    items = frappe.get_all(
+        "Item",
+        filters={"hiboutik_id": ["in", list(external_ids)]},
+        fields=["name", "hiboutik_id"],
+    )
+    return {item.hiboutik_id: item.name for item in items}
 
 
-def get_hiboutik_tax_id(item: Document, hb_settings: Document) -> int:
-    """Returns the Hiboutik's tax ID corresponding to the tax set for the Item."""
+def get_hiboutik_tax_id_from_template(itt_name: str, hb_settings: Document) -> int:
+    """Returns the Hiboutik's tax ID corresponding to an Item Tax Template."""
     HIBOUTIK_20_TAX_ID = 1
     HIBOUTIK_10_TAX_ID = 2
     HIBOUTIK_5_5_TAX_ID = 3
     HIBOUTIK_2_1_TAX_ID = 4
     HIBOUTIK_NO_TAX_ID = 5
 
-    itt_name = get_item_tax_template_name(item)
-
     if hb_settings.tva_20 == itt_name:
         return HIBOUTIK_20_TAX_ID
 
@@ -307,29 +1020,3 @@ def get_hiboutik_tax_id(item: Document, hb_settings: Document) -> int:
         return HIBOUTIK_2_1_TAX_ID
 
     return HIBOUTIK_NO_TAX_ID
-
-
-# FIXME: maybe there is an erpnext function doing a better job.
-def get_item_tax_template_name(item: Document) -> str:
-    """Given an Item returns the first Tax Template found either at the Item level
-    or at the Item Group level. Returns an empty string if no tax template has been set for this item."""
-
-    def get_item_tax():
-        try:
-            return item.taxes[0].item_tax_template
-        except IndexError:
-            return None
-
-    def get_item_group_tax():
-        group = frappe.get_doc("Item Group", item.item_group)
-        try:
-            return group.taxes[0].item_tax_template
-        except IndexError:
-            return None
-
-    for getter in [get_item_tax, get_item_group_tax]:
-        itt_name = getter()
-        if itt_name:
-            return itt_name
-
-    return ""
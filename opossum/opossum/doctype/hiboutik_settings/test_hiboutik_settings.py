@@ -4,14 +4,42 @@
 from __future__ import unicode_literals
 
 import json
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import frappe
-from opossum.opossum.hiboutik import HiboutikAPIError, HiboutikConnector
-from opossum.opossum.models import Item
+from frappe.utils import add_to_date, get_datetime, now_datetime
+from opossum.opossum.doctype.hiboutik_sale.hiboutik_sale import make_sale
+from opossum.opossum.doctype.hiboutik_sync_run.hiboutik_sync_run import make_sync_run
+from opossum.opossum.hiboutik import (
+    HiboutikAPIError,
+    HiboutikConnector,
+    HiboutikUnavailableError,
+    ProductCatalog,
+)
+from opossum.opossum.hiboutik_async import SyncResult
+from opossum.opossum.models import Item, POSInvoice, POSInvoiceItem
 
-from .hiboutik_settings import pos_invoice_webhook, sync_item
+from .hiboutik_settings import (
+    PENDING_SYNC_CACHE_KEY,
+    PENDING_SYNC_DEBOUNCE,
+    SYNC_CHUNK_SIZE,
+    _get_prices,
+    _make_items,
+    _sync_item_codes,
+    get_hiboutik_api_from_settings,
+    get_item_codes_modified_since,
+    cancel_sync_all_items,
+    enqueue_pending_item_syncs,
+    mark_item_for_sync,
+    pos_invoice_webhook,
+    process_pending_sales,
+    resolve_and_set_item_codes,
+    sync_item,
+    sync_items_chunk,
+    sync_queued_items,
+)
 
 
 def create_pos_profile():
@@ -166,6 +194,105 @@ class TestHiboutikSettings(unittest.TestCase):
         assert item.price == 10.0
         assert item.vat == 1
 
+    def test_items_are_built_in_bulk(self):
+        settings = frappe.get_doc("Hiboutik Settings")
+        settings.pos_profile = "_Opossum Hiboutik"
+        frappe.db.set_value("Item", "_opossum_item1", "is_stock_item", 0)
+
+        items = _make_items(["_opossum_item1", "_unknown_item"], settings)
+
+        assert list(items) == ["_opossum_item1"]
+        assert items["_opossum_item1"].code == "_opossum_item1"
+        assert items["_opossum_item1"].is_stock_item == 0
+
+    def test_stocked_item_without_bin_is_not_built(self):
+        settings = frappe.get_doc("Hiboutik Settings")
+        settings.pos_profile = "_Opossum Hiboutik"
+        frappe.db.set_value("Item", "_opossum_item1", "is_stock_item", 1)
+
+        items = _make_items(["_opossum_item1"], settings)
+
+        assert items["_opossum_item1"] is None
+
+    def test_variant_falls_back_to_the_template_price(self):
+        pos_profile = frappe._dict(selling_price_list="Standard Selling")
+        rows = [
+            frappe._dict(item_code="_template", price_list_rate=12.0),
+            frappe._dict(item_code="_priced_variant", price_list_rate=15.0),
+        ]
+
+        with patch.object(frappe.db, "exists", return_value=None), patch(
+            "frappe.get_all", return_value=rows
+        ) as get_all:
+            prices = _get_prices(
+                ["_variant", "_priced_variant", "_unpriced"],
+                pos_profile,
+                templates={"_variant": "_template", "_priced_variant": "_template"},
+            )
+
+        assert prices == {"_variant": 12.0, "_priced_variant": 15.0}
+        get_all.assert_called_once()
+        item_codes = get_all.call_args.kwargs["filters"]["item_code"][1]
+        assert "_template" in item_codes
+
+    def test_item_codes_are_resolved_in_one_query(self):
+        frappe.db.set_value("Item", "_opossum_item1", "hiboutik_id", "T_Item1")
+        pos_invoice = POSInvoice(
+            posting_date=now_datetime(),
+            invoice_items=[
+                POSInvoiceItem(qty=1, external_id="T_Item1"),
+                POSInvoiceItem(qty=2, external_id="T_Item1"),
+            ],
+        )
+
+        with patch.object(frappe.db, "sql", wraps=frappe.db.sql) as sql:
+            resolve_and_set_item_codes(pos_invoice)
+
+        assert sql.call_count == 1
+        assert [i.code for i in pos_invoice.invoice_items] == ["_opossum_item1"] * 2
+
+    def test_unknown_products_are_all_reported(self):
+        pos_invoice = POSInvoice(
+            posting_date=now_datetime(),
+            invoice_items=[
+                POSInvoiceItem(qty=1, external_id="_unknown1"),
+                POSInvoiceItem(qty=1, external_id="_unknown2"),
+            ],
+        )
+
+        with self.assertRaises(frappe.ValidationError) as cm:
+            resolve_and_set_item_codes(pos_invoice)
+
+        assert "_unknown1, _unknown2" in str(cm.exception)
+
+    def test_unreachable_hiboutik_is_reported_as_such(self):
+        settings = frappe.get_doc("Hiboutik Settings")
+        settings.enable_sync = True
+
+        with patch.object(
+            HiboutikConnector,
+            "set_sale_webhook",
+            side_effect=HiboutikUnavailableError("Circuit open"),
+        ), patch("frappe.msgprint") as msgprint:
+            settings.make_and_set_webhook_urls()
+
+        assert "injoignable" in msgprint.call_args[1]["msg"]
+
+    def test_client_is_throttled_as_set(self):
+        settings = frappe._dict(
+            instance_name="_throttled",
+            username="user",
+            api_key="key",
+            modified="2021-10-29",
+            max_concurrent_requests=32,
+            max_requests_per_second=50,
+        )
+
+        api = get_hiboutik_api_from_settings(settings)
+
+        assert api.scheduler.limiter.maximum == 32
+        assert api.scheduler.bucket.rate == 50
+
     def test_enabling_hiboutik_create_custom_item_fields(self):
         with patch.object(HiboutikConnector, "set_sale_webhook"):
             settings = frappe.get_doc("Hiboutik Settings")
@@ -183,6 +310,398 @@ class TestHiboutikSettings(unittest.TestCase):
             assert item_dt.has_field("hiboutik_id") is True
 
 
+class TestQueuedItemSync(unittest.TestCase):
+    def setUp(self):
+        create_pos_profile()
+        frappe.cache().delete_value(PENDING_SYNC_CACHE_KEY)
+
+    def tearDown(self):
+        frappe.cache().delete_value(PENDING_SYNC_CACHE_KEY)
+
+    def test_repeated_changes_are_queued_once(self):
+        doc = frappe.get_doc("Item", "_opossum_item1")
+        doc.sync_with_hiboutik = 1
+
+        with patch.object(frappe.db, "get_single_value", return_value=1):
+            for _ in range(10):
+                mark_item_for_sync(doc)
+
+        pending = frappe.cache().hgetall(PENDING_SYNC_CACHE_KEY)
+        assert list(pending) == [b"_opossum_item1"]
+
+    def test_repriced_template_queues_its_variants(self):
+        doc = frappe._dict(doctype="Item Price", item_code="_template")
+
+        with patch.object(frappe.db, "get_single_value", return_value=1), patch(
+            "frappe.get_all", return_value=["_variant"]
+        ):
+            mark_item_for_sync(doc)
+
+        pending = frappe.cache().hgetall(PENDING_SYNC_CACHE_KEY)
+        assert set(pending) == {b"_template", b"_variant"}
+
+    def test_only_settled_items_are_enqueued(self):
+        now = time.time()
+        frappe.cache().hset(
+            PENDING_SYNC_CACHE_KEY, "_settled", now - PENDING_SYNC_DEBOUNCE - 1
+        )
+        frappe.cache().hset(PENDING_SYNC_CACHE_KEY, "_still_changing", now)
+
+        with patch("frappe.enqueue") as enqueue:
+            enqueue_pending_item_syncs()
+
+        enqueue.assert_called_once()
+        assert enqueue.call_args[1]["item_codes"] == ["_settled"]
+        pending = frappe.cache().hgetall(PENDING_SYNC_CACHE_KEY)
+        assert list(pending) == [b"_still_changing"]
+
+    def sync_queued_items(self, item_codes, side_effect=None):
+        module = "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings"
+        get_all = frappe.get_all
+
+        def get_items(doctype, *args, filters=None, **kwargs):
+            if doctype == "Item":
+                return filters["item_code"][1]
+            return get_all(doctype, *args, filters=filters, **kwargs)
+
+        with patch(
+            "frappe.get_single", return_value=frappe._dict(enable_sync=1)
+        ), patch("frappe.get_all", side_effect=get_items), patch(
+            f"{module}._sync_item_codes", return_value=[], side_effect=side_effect
+        ) as sync, patch(
+            "frappe.enqueue"
+        ) as enqueue:
+            try:
+                sync_queued_items(item_codes)
+            except HiboutikAPIError:
+                pass
+        return sync, enqueue
+
+    def test_queued_items_are_synced_by_chunks(self):
+        frappe.db.delete("Hiboutik Sync Run")
+        item_codes = [f"_item{n}" for n in range(SYNC_CHUNK_SIZE + 1)]
+
+        sync, enqueue = self.sync_queued_items(item_codes)
+
+        assert sync.call_args[0][0] == item_codes[:SYNC_CHUNK_SIZE]
+        assert enqueue.call_args[1]["item_codes"] == item_codes[SYNC_CHUNK_SIZE:]
+        assert enqueue.call_args[1]["queue"] == "long"
+
+    def test_items_of_a_running_sync_are_left_to_it(self):
+        frappe.db.delete("Hiboutik Sync Run")
+        run = make_sync_run(["_item0", "_item1"], 0, now_datetime(), "Administrator")
+        run.checkpoint(in_flight_items=["_item0"])
+
+        sync, _ = self.sync_queued_items(["_item0", "_item1", "_item2"])
+
+        assert sync.call_args[0][0] == ["_item2"]
+        pending = frappe.cache().hgetall(PENDING_SYNC_CACHE_KEY)
+        assert list(pending) == [b"_item0"]
+        frappe.db.delete("Hiboutik Sync Run")
+
+    def test_chunk_is_queued_again_when_it_cannot_be_synced(self):
+        frappe.db.delete("Hiboutik Sync Run")
+
+        self.sync_queued_items(["_item0"], side_effect=HiboutikAPIError("Down"))
+
+        pending = frappe.cache().hgetall(PENDING_SYNC_CACHE_KEY)
+        assert list(pending) == [b"_item0"]
+
+
+class TestModifiedItems(unittest.TestCase):
+    def setUp(self):
+        create_pos_profile()
+        self.settings = frappe._dict(pos_profile="_Opossum Hiboutik")
+
+    def test_modified_item_is_selected(self):
+        watermark = add_to_date(now_datetime(), seconds=-1)
+        frappe.db.set_value("Item", "_opossum_item1", "description", "Modified")
+
+        item_codes = get_item_codes_modified_since(watermark, self.settings)
+
+        assert "_opossum_item1" in item_codes
+
+    def test_item_modified_before_the_watermark_is_not_selected(self):
+        frappe.db.set_value("Item", "_opossum_item1", "description", "Modified")
+        watermark = add_to_date(now_datetime(), seconds=1)
+
+        item_codes = get_item_codes_modified_since(watermark, self.settings)
+
+        assert "_opossum_item1" not in item_codes
+
+    def test_stock_moves_are_read_from_the_ledger(self):
+        pos_profile = frappe.get_doc("POS Profile", "_Opossum Hiboutik")
+        get_all = frappe.get_all
+
+        def get_moved_items(doctype, *args, **kwargs):
+            if doctype == "Stock Ledger Entry":
+                assert ["warehouse", "=", pos_profile.warehouse] in kwargs["filters"]
+                return ["_moved_item"]
+            return get_all(doctype, *args, **kwargs)
+
+        with patch("frappe.get_all", side_effect=get_moved_items):
+            item_codes = get_item_codes_modified_since(now_datetime(), self.settings)
+
+        assert "_moved_item" in item_codes
+
+    def test_variants_of_repriced_templates_are_selected(self):
+        get_all = frappe.get_all
+
+        def get_repriced_items(doctype, *args, filters=None, **kwargs):
+            if doctype == "Item Price":
+                return ["_template"]
+            if doctype == "Item" and "variant_of" in filters:
+                assert filters["variant_of"] == ["in", ["_template"]]
+                return ["_variant"]
+            return get_all(doctype, *args, filters=filters, **kwargs)
+
+        with patch("frappe.get_all", side_effect=get_repriced_items):
+            item_codes = get_item_codes_modified_since(now_datetime(), self.settings)
+
+        assert {"_template", "_variant"} <= item_codes
+
+
+class TestSyncAllItemsJobs(unittest.TestCase):
+    def setUp(self):
+        frappe.db.delete("Hiboutik Sync Run")
+        self.item_codes = [f"_item{n}" for n in range(SYNC_CHUNK_SIZE + 1)]
+        self.run = make_sync_run(self.item_codes, 0, now_datetime(), "Administrator")
+        self.module = "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings"
+
+    def sync_chunk(self, failed=()):
+        with patch(
+            f"{self.module}._sync_item_codes", return_value=list(failed)
+        ) as sync, patch("frappe.enqueue") as enqueue, patch(
+            "frappe.publish_realtime"
+        ):
+            sync_items_chunk(self.run.name)
+        self.run.reload()
+        return sync, enqueue
+
+    def test_chunk_enqueues_the_next_one(self):
+        sync, enqueue = self.sync_chunk()
+
+        assert sync.call_args[0][0] == self.item_codes[:SYNC_CHUNK_SIZE]
+        assert sync.call_args[1]["adopt_orphans"] is False
+        enqueue.assert_called_once()
+        assert self.run.done_items == SYNC_CHUNK_SIZE
+        assert self.run.get_in_flight_items() == []
+
+    def test_chunk_stores_the_metrics_of_its_calls(self):
+        settings = frappe.get_single("Hiboutik Settings")
+        frappe.db.delete("Hiboutik API Metrics")
+
+        def sync(*args, **kwargs):
+            api = get_hiboutik_api_from_settings(settings)
+            api.metrics.record("GET products", 200, 0.1)
+            return []
+
+        with patch(f"{self.module}._sync_item_codes", side_effect=sync), patch(
+            "frappe.enqueue"
+        ), patch("frappe.publish_realtime"):
+            sync_items_chunk(self.run.name)
+
+        source = frappe.db.get_value("Hiboutik API Metrics", {}, "source")
+        assert source == f"{self.run.name}, {SYNC_CHUNK_SIZE}/{SYNC_CHUNK_SIZE + 1}"
+
+    def test_chunks_of_a_run_share_the_catalog(self):
+        settings = frappe.get_single("Hiboutik Settings")
+        items = {"_item0": Item("_item0", "Item 0", "1.0", 1, False)}
+
+        with patch(f"{self.module}._make_items", return_value=items), patch(
+            f"{self.module}.sync_items"
+        ), patch.object(
+            ProductCatalog, "load", return_value=ProductCatalog()
+        ) as load:
+            for _ in range(2):
+                _sync_item_codes(["_item0"], settings, run=self.run.name)
+
+        load.assert_called_once()
+        frappe.cache().delete_value(f"hiboutik_sync_catalog:{self.run.name}")
+
+    def test_few_changed_items_dont_load_the_catalog(self):
+        settings = frappe.get_single("Hiboutik Settings")
+        items = {"_item0": Item("_item0", "Item 0", "1.0", 1, False, external_id="42")}
+
+        with patch(f"{self.module}._make_items", return_value=items), patch(
+            f"{self.module}.sync_items"
+        ) as sync_items, patch.object(ProductCatalog, "load") as load:
+            _sync_item_codes(["_item0"], settings)
+
+        load.assert_not_called()
+        assert len(sync_items.call_args[1]["catalog"]) == 0
+
+    def test_product_created_before_a_failure_is_kept(self):
+        settings = frappe.get_single("Hiboutik Settings")
+        items = {"_item0": Item("_item0", "Item 0", "1.0", 1, True, stock_qty=2)}
+
+        def sync_items(api, items, on_synced=None, **kwargs):
+            items[0].external_id = "77"
+            on_synced([SyncResult(items[0], HiboutikAPIError("Inventory"))])
+
+        with patch(f"{self.module}._make_items", return_value=items), patch(
+            f"{self.module}.sync_items", side_effect=sync_items
+        ), patch(f"{self.module}._save_synced_item") as save_synced_item:
+            failed = _sync_item_codes(["_item0"], settings)
+
+        assert failed == ["_item0"]
+        stored_item, saved_item = save_synced_item.call_args[0]
+        assert stored_item.external_id == ""
+        assert saved_item.external_id == "77"
+        assert saved_item.fingerprint == stored_item.fingerprint
+
+    def test_last_chunk_ends_the_run(self):
+        self.sync_chunk(failed=["_item0"])
+        sync, enqueue = self.sync_chunk()
+
+        assert sync.call_args[0][0] == self.item_codes[SYNC_CHUNK_SIZE:]
+        enqueue.assert_not_called()
+        assert self.run.status == "Failed"
+        assert self.run.get_failed_items() == ["_item0"]
+
+    def test_completed_run_advances_the_watermark(self):
+        frappe.db.set_value("Hiboutik Settings", None, "last_sync_watermark", None)
+        self.sync_chunk()
+        self.sync_chunk()
+
+        assert self.run.status == "Completed"
+        watermark = frappe.db.get_single_value(
+            "Hiboutik Settings", "last_sync_watermark"
+        )
+        assert get_datetime(watermark) == get_datetime(self.run.started_at)
+
+    def test_failed_run_keeps_the_watermark(self):
+        frappe.db.set_value("Hiboutik Settings", None, "last_sync_watermark", None)
+        self.sync_chunk(failed=["_item0"])
+        self.sync_chunk()
+
+        assert self.run.status == "Failed"
+        assert not frappe.db.get_single_value(
+            "Hiboutik Settings", "last_sync_watermark"
+        )
+
+    def test_interrupted_chunk_is_resumed_and_repaired(self):
+        self.run.checkpoint(in_flight_items=self.item_codes[:SYNC_CHUNK_SIZE])
+
+        sync, enqueue = self.sync_chunk()
+
+        assert sync.call_args[0][0] == self.item_codes[:SYNC_CHUNK_SIZE]
+        assert sync.call_args[1]["adopt_orphans"] is True
+
+    def test_run_is_synced_by_a_single_job(self):
+        with patch.object(frappe.db, "sql", return_value=((0,),)), patch(
+            f"{self.module}._sync_item_codes"
+        ) as sync, patch("frappe.enqueue") as enqueue:
+            sync_items_chunk(self.run.name)
+
+        sync.assert_not_called()
+        enqueue.assert_not_called()
+
+    def test_cancelled_run_stops(self):
+        cancel_sync_all_items()
+
+        sync, enqueue = self.sync_chunk()
+
+        sync.assert_not_called()
+        enqueue.assert_not_called()
+        assert self.run.status == "Cancelled"
+
+
 class TestHiboutikWebhooks(unittest.TestCase):
     def test_pos_invoice_received(self):
         pass  # assert pos_invoice_webhook() is True
+
+    def test_sale_is_stored_then_processed_in_background(self):
+        frappe.local.request = Mock(form={"sale_id": "1"})
+
+        with patch("frappe.enqueue") as enqueue:
+            name = pos_invoice_webhook()
+
+        assert frappe.db.get_value("Hiboutik Sale", name, "status") == "Pending"
+        enqueue.assert_called_once()
+        frappe.delete_doc("Hiboutik Sale", name)
+
+    def test_sale_posted_again_is_ignored(self):
+        frappe.db.delete("Hiboutik Sale")
+        frappe.local.request = Mock(form={"sale_id": "3"})
+
+        with patch("frappe.enqueue") as enqueue:
+            name = pos_invoice_webhook()
+            assert pos_invoice_webhook() == name
+
+        enqueue.assert_called_once()
+        assert frappe.db.count("Hiboutik Sale", {"sale_id": "3"}) == 1
+        frappe.delete_doc("Hiboutik Sale", name)
+
+    def test_failed_sale_is_kept(self):
+        frappe.db.delete("Hiboutik Sale")
+        sale = make_sale({"sale_id": "2"})  # No completed_at
+        module = "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings"
+
+        with patch(
+            f"{module}.get_or_create_opening_entry", return_value=(Mock(), False)
+        ):
+            process_pending_sales()
+
+        sale.reload()
+        assert sale.status == "Failed"
+        assert "KeyError" in sale.error
+        frappe.delete_doc("Hiboutik Sale", sale.name)
+
+    def test_no_opening_entry_without_pending_sale(self):
+        frappe.db.delete("Hiboutik Sale")
+        module = "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings"
+
+        with patch(f"{module}.get_or_create_opening_entry") as get_opening_entry:
+            process_pending_sales()
+
+        get_opening_entry.assert_not_called()
+
+    def test_sales_are_left_to_the_running_job(self):
+        frappe.db.delete("Hiboutik Sale")
+        sale = make_sale({"sale_id": "4"})
+        module = "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings"
+
+        with patch.object(frappe.db, "sql", return_value=((0,),)), patch(
+            f"{module}._process_sale_batch"
+        ) as process_sale_batch:
+            process_pending_sales()
+
+        process_sale_batch.assert_not_called()
+        frappe.delete_doc("Hiboutik Sale", sale.name)
+
+    def test_sales_are_invoiced_by_batch(self):
+        frappe.db.delete("Hiboutik Sale")
+        sales = [make_sale({"sale_id": str(n)}) for n in range(10, 13)]
+        module = "opossum.opossum.doctype.hiboutik_settings.hiboutik_settings"
+
+        def make_pos_invoice(pos_invoice, *args, commit=True, **kwargs):
+            assert not commit
+            return frappe._dict(name="ACC-PSINV-TEST")
+
+        pos_invoice = POSInvoice(posting_date=now_datetime(), invoice_items=[])
+        payloads = [pos_invoice, KeyError("completed_at"), pos_invoice]
+        with patch(
+            f"{module}.get_or_create_opening_entry", return_value=(Mock(), False)
+        ) as get_opening_entry, patch(
+            f"{module}.convert_payload_to_POS_invoice", side_effect=payloads
+        ), patch(
+            f"{module}.get_item_codes_from_external_ids", return_value={}
+        ) as get_item_codes, patch(
+            f"{module}.resolve_and_set_item_codes"
+        ), patch(
+            f"{module}.make_pos_invoice", side_effect=make_pos_invoice
+        ), patch.object(
+            frappe.db, "commit"
+        ) as commit:
+            process_pending_sales()
+
+        statuses = [
+            frappe.db.get_value("Hiboutik Sale", sale.name, "status") for sale in sales
+        ]
+        assert statuses == ["Processed", "Failed", "Processed"]
+        commit.assert_called_once()
+        get_opening_entry.assert_called_once()
+        get_item_codes.assert_called_once()
+        for sale in sales:
+            frappe.delete_doc("Hiboutik Sale", sale.name)
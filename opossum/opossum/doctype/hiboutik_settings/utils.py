@@ -1,20 +1,21 @@
+from collections import defaultdict
 from datetime import datetime
 import re
+from typing import Dict
 
 from opossum.opossum.models import POSInvoice, POSInvoiceItem
 
+LINE_ITEM_KEY = re.compile(r"line_items\[(\d+)\]\[(.*)\]")
+
 
 def convert_payload_to_POS_invoice(data: dict) -> POSInvoice:
+    lines = _fetch_lines(data)
+
     invoice_items = []
     line_index = 0
-
-    invoice_item = _make_POS_invoice_item(data, line_index)
-    invoice_items.append(invoice_item)
-    while invoice_item:
+    while line_index in lines:
+        invoice_items.append(_make_POS_invoice_item(lines[line_index]))
         line_index += 1
-        invoice_item = _make_POS_invoice_item(data, line_index)
-        if invoice_item:
-            invoice_items.append(invoice_item)
 
     return POSInvoice(
         # FIXME: check timezone
@@ -23,21 +24,22 @@ def convert_payload_to_POS_invoice(data: dict) -> POSInvoice:
     )
 
 
-def _fetch_props(data, line_index):
-    rv = {}
-    pattern = re.compile(f"line_items\[{str(line_index)}\]\[(.*)\]")
+def _fetch_lines(data: dict) -> Dict[int, dict]:
+    """The fields of each line, by line index, read in a single pass."""
+    rv = defaultdict(dict)
     for k, v in data.items():
-        if k.startswith(f"line_items[{str(line_index)}]"):
-            match = pattern.match(k)
-            rv[match.groups()[0]] = v
+        if k.startswith("line_items["):
+            match = LINE_ITEM_KEY.fullmatch(k)
+            if match:
+                rv[int(match.group(1))][match.group(2)] = v
     return rv
 
 
-def _make_POS_invoice_item(data: dict, line_index: int) -> POSInvoiceItem or None:
-    item_data = _fetch_props(data, line_index)
-    if not item_data:
-        return None
-
+def _make_POS_invoice_item(item_data: dict) -> POSInvoiceItem:
     return POSInvoiceItem(
-        qty=int(item_data["quantity"]), external_id=item_data["product_id"]
+        qty=int(item_data["quantity"]),
+        external_id=item_data["product_id"],
+        price=item_data.get("product_price", ""),
+        tax_value=item_data.get("tax_value", ""),
+        discount=item_data.get("discount", ""),
     )
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, ioCraft and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+
+import json
+from typing import List
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_to_date, get_datetime, now_datetime
+
+#: Minutes without checkpoint after which a running sync is considered dead.
+STALE_RUN_MINUTES = 30
+
+
+class HiboutikSyncRun(Document):
+    @property
+    def is_stale(self) -> bool:
+        last_checkpoint = get_datetime(self.modified)
+        return last_checkpoint < add_to_date(now_datetime(), minutes=-STALE_RUN_MINUTES)
+
+    def get_item_codes(self) -> List[str]:
+        return json.loads(self.item_codes or "[]")
+
+    def get_failed_items(self) -> List[str]:
+        return json.loads(self.failed_items or "[]")
+
+    def get_in_flight_items(self) -> List[str]:
+        return json.loads(self.in_flight_items or "[]")
+
+    def checkpoint(self, **values):
+        """Persists and commits the progress of the run, lists being stored as JSON"""
+        for fieldname in ("failed_items", "in_flight_items"):
+            if fieldname in values:
+                values[fieldname] = json.dumps(values[fieldname])
+        self.db_set(values, commit=True)
+
+
+def make_sync_run(
+    item_codes: List[str], only_modified: bool, started_at, user: str
+) -> Document:
+    doc = frappe.get_doc(
+        {
+            "doctype": "Hiboutik Sync Run",
+            "status": "Running",
+            "started_at": started_at,
+            "only_modified": only_modified,
+            "user": user,
+            "total_items": len(item_codes),
+            "done_items": 0,
+            "item_codes": json.dumps(item_codes),
+            "failed_items": "[]",
+            "in_flight_items": "[]",
+        }
+    )
+    doc.insert(ignore_permissions=True)
+    return doc
+
+
+def get_running_sync_run() -> Document or None:
+    """Returns the latest run still running, or which died before its end"""
+    name = frappe.db.get_value(
+        "Hiboutik Sync Run", {"status": "Running"}, order_by="creation desc"
+    )
+    return frappe.get_doc("Hiboutik Sync Run", name) if name else None
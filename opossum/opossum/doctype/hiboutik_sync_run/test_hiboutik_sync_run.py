@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, ioCraft and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import unittest
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+from .hiboutik_sync_run import get_running_sync_run, make_sync_run
+
+
+class TestHiboutikSyncRun(unittest.TestCase):
+    def setUp(self):
+        frappe.db.delete("Hiboutik Sync Run")
+
+    def test_checkpoint(self):
+        run = make_sync_run(["a", "b"], False, now_datetime(), "Administrator")
+
+        run.checkpoint(done_items=1, failed_items=["a"], in_flight_items=["b"])
+
+        run = get_running_sync_run()
+        assert run.done_items == 1
+        assert run.get_failed_items() == ["a"]
+        assert run.get_in_flight_items() == ["b"]
+        assert not run.is_stale
+
+    def test_run_without_checkpoint_is_stale(self):
+        run = make_sync_run(["a"], False, now_datetime(), "Administrator")
+        frappe.db.set_value(
+            "Hiboutik Sync Run",
+            run.name,
+            "modified",
+            add_to_date(now_datetime(), hours=-1),
+            update_modified=False,
+        )
+
+        assert get_running_sync_run().is_stale
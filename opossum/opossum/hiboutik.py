@@ -1,11 +1,28 @@
-from dataclasses import dataclass
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
 from logging import getLogger
-from typing import List
+from typing import Dict, Iterator, List, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
+from opossum.opossum.metrics import HiboutikMetrics
 from opossum.opossum.models import Item
+from opossum.opossum.throttling import (
+    CircuitOpenError,
+    Deadline,
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_RATE,
+    DeadlineExceededError,
+    RequestScheduler,
+)
+from opossum.opossum.tracing import RequestTracer
 
 LOGGER = getLogger(__name__)
 
@@ -16,6 +33,15 @@ SALE_WEBHOOK_APP_ID = "ERPNEXT"
 HIBOUTIK_DEFAULT_STOCK_ID = 1
 HIBOUTIK_DEFAULT_PRODUCT_SIZE = 0
 
+#: Number of keep-alive connections kept open to a Hiboutik instance.
+HIBOUTIK_DEFAULT_POOL_MAXSIZE = 10
+
+#: Query parameter selecting the page of a paginated Hiboutik listing, starting at 1.
+HIBOUTIK_PAGE_PARAM = "p"
+
+#: Seconds to wait for the connection to Hiboutik, then for each response.
+HIBOUTIK_DEFAULT_TIMEOUT = (3.05, 20)
+
 
 class HiboutikStoreError(BaseException):
     pass
@@ -29,6 +55,31 @@ class HiboutikAPIInsufficientRightsError(BaseException):
     pass
 
 
+class HiboutikTimeoutError(HiboutikAPIError):
+    pass
+
+
+class HiboutikUnavailableError(HiboutikAPIError):
+    """Hiboutik can't be reached or is considered down, the call failed fast."""
+
+    pass
+
+
+class HiboutikPartialUpdateError(HiboutikAPIError):
+    """Some attributes of a product were updated, some were not."""
+
+    def __init__(
+        self, product_id, applied: List[str], failed: Dict[str, BaseException]
+    ):
+        super().__init__(
+            f"Product {product_id}: failed to update {', '.join(failed)}"
+            f" ({', '.join(applied) or 'nothing'} applied)"
+        )
+        self.product_id = product_id
+        self.applied = applied
+        self.failed = failed
+
+
 @dataclass
 class ProductData:
 
@@ -53,6 +104,20 @@ class ProductData:
         return self.__dict__.copy()
 
 
+def fingerprint(item: Item) -> str:
+    """Hash of what Hiboutik should hold for the item: its product data and,
+    for a stocked item, its stock quantity."""
+    data = ProductData.create(item).data
+    if item.is_stock_item:
+        data["stock_qty"] = item.stock_qty
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def is_up_to_date(item: Item) -> bool:
+    """Whether the item is known to Hiboutik as it is now, per its fingerprint."""
+    return bool(item.external_id) and item.fingerprint == fingerprint(item)
+
+
 @dataclass
 class ProductStock:
 
@@ -160,14 +225,146 @@ class InventoryInputDetailData:
     product_size: int
 
 
+class ProductCatalog:
+    """Local snapshot of the Hiboutik catalog.
+
+    Loaded with a single pass over the paginated product listing, then kept
+    fresh by the connector from its own writes, so that diffing an item does
+    not need a `get_product` call."""
+
+    def __init__(self, products: List[Product] = ()):
+        self._products: Dict[int, Product] = {}
+        self._lock = threading.Lock()
+        for product in products:
+            self.put(product)
+
+    @classmethod
+    def load(cls, api) -> "ProductCatalog":
+        return ProductCatalog(api.iter_products())
+
+    @classmethod
+    def from_data(cls, data: List[dict]) -> "ProductCatalog":
+        """Builds back a catalog stored with `to_data`."""
+        return ProductCatalog(Product.create_from_data(product) for product in data)
+
+    def to_data(self, stocked=True) -> List[dict]:
+        """The products as plain data, e.g. to keep the catalog between jobs.
+        Without `stocked`, the products whose stock is managed are left out, as
+        their stock goes stale as soon as something is sold."""
+        with self._lock:
+            return [
+                asdict(product)
+                for product in self._products.values()
+                if stocked or not product.product_stock_management
+            ]
+
+    def __len__(self):
+        return len(self._products)
+
+    def get(self, product_id) -> Product or None:
+        with self._lock:
+            return self._products.get(int(product_id))
+
+    def put(self, product: Product):
+        with self._lock:
+            self._products[int(product.product_id)] = product
+
+    def find_orphan(self, item: Item, linked_ids) -> Product or None:
+        """Returns a product named as the item but linked to no ERPNext item, as
+        created for it by a sync which died before storing its Hiboutik ID."""
+        with self._lock:
+            for product in self._products.values():
+                if (
+                    product.product_model == item.name
+                    and str(product.product_id) not in linked_ids
+                ):
+                    return product
+        return None
+
+    def record_sync(self, item: Item, product: Product = None):
+        """Stores what Hiboutik holds for the item once it has been synced."""
+        if item.is_stock_item:
+            stock_available = [ProductStock(stock_available=item.stock_qty)]
+        elif product:
+            stock_available = product.stock_available
+        else:
+            stock_available = []
+        self.put(
+            Product(
+                product_id=int(item.external_id),
+                stock_available=stock_available,
+                **ProductData.create(item).data,
+            )
+        )
+
+
+class InventoryInputBatch:
+    """A single Hiboutik inventory input collecting the stock moves of many products.
+
+    The input is created with the first line and validated once, by `validate`,
+    so that syncing the stock of N products costs N+2 calls instead of 3N."""
+
+    def __init__(self, api, stock_id=HIBOUTIK_DEFAULT_STOCK_ID):
+        self.api = api
+        self.stock_id = stock_id
+        self.inventory_input_id = None
+        self.lines = 0
+        self._lock = threading.Lock()
+
+    def _get_inventory_input_id(self) -> int:
+        with self._lock:
+            if self.inventory_input_id is None:
+                self.inventory_input_id = self.api.post_inventory_input(
+                    InventoryInputData(self.stock_id)
+                )
+            return self.inventory_input_id
+
+    def add(self, product_id: int, quantity: int):
+        self.api.post_inventory_input_details(
+            self._get_inventory_input_id(),
+            InventoryInputDetailData(
+                quantity, product_id, HIBOUTIK_DEFAULT_PRODUCT_SIZE
+            ),
+        )
+        with self._lock:
+            self.lines += 1
+
+    def validate(self):
+        """Applies all the collected lines. Does nothing if no line was added."""
+        if self.inventory_input_id is not None:
+            self.api.validate_inventory_input(self.inventory_input_id)
+
+
 class HiboutikConnector:
-    def __init__(self, api):
+    def __init__(
+        self,
+        api,
+        catalog: ProductCatalog = None,
+        inventory: InventoryInputBatch = None,
+    ):
         self.api = api
+        self.catalog = catalog
+        self.inventory = inventory
+
+    def _get_product(self, product_id) -> Product:
+        if self.catalog is not None:
+            product = self.catalog.get(product_id)
+            if product is not None:
+                return product
+        return self.api.get_product(product_id)
 
     def sync(self, item: Item):
+        """Pushes the item to Hiboutik, unless it is up to date.
+
+        The item's fingerprint is updated once synced. With an inventory batch,
+        the stock is only applied when the batch is validated."""
+        if is_up_to_date(item):
+            return item
+
         if item.external_id:
-            # FIXME: handle partial update due to some failures (some calls succeed, some don't).
-            existing_product = self.api.get_product(item.external_id)
+            # A partially applied update (HiboutikPartialUpdateError) leaves the
+            # fingerprint as it was: the next sync diffs the product again.
+            existing_product = self._get_product(item.external_id)
             update = []
             existing_data = existing_product.data
             for k, v in ProductData.create(item).data.items():
@@ -178,12 +375,17 @@ class HiboutikConnector:
                 item, existing_product.product_id, existing_product
             )
         else:
+            existing_product = None
             item.external_id = str(self.api.post_product(Product.create(item)))
             synced_item = SyncedItem(item, int(item.external_id))
 
         if item.is_stock_item:
-            StockSyncer(self.api).sync(synced_item)
+            StockSyncer(self.api, self.inventory).sync(synced_item)
+
+        if self.catalog is not None:
+            self.catalog.record_sync(item, existing_product)
 
+        item.fingerprint = fingerprint(item)
         return item
 
     def set_sale_webhook(self, webhook: Webhook):
@@ -210,8 +412,12 @@ class HiboutikConnector:
 
 
 class StockSyncer:
-    def __init__(self, api):
+    """Brings the Hiboutik stock of an item to its ERPNext level.
+    With an `inventory` batch, the stock move is only added to it."""
+
+    def __init__(self, api, inventory: InventoryInputBatch = None):
         self.api = api
+        self.inventory = inventory
 
     def sync(self, item: SyncedItem):
         if not item.is_stock_item:
@@ -224,14 +430,69 @@ class StockSyncer:
         )
 
         diff = item.stock_qty - pos_stock
-        if diff != 0:
+        if diff == 0:
+            return
+        if self.inventory is not None:
+            self.inventory.add(product_id=item.external_id, quantity=diff)
+        else:
             self.api.post_inventory_input_for_product(
                 product_id=item.external_id, quantity=diff
             )
 
 
+class SessionPool:
+    """Sessions lent to one request at a time, so that concurrent workers never
+    share a session. Grows with the number of concurrent requests, keeping at
+    most `max_idle` sessions, and their keep-alive connection, between calls."""
+
+    def __init__(self, factory, max_idle=HIBOUTIK_DEFAULT_POOL_MAXSIZE):
+        self._factory = factory
+        self.max_idle = max_idle
+        self._idle: List[requests.Session] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self) -> Iterator[requests.Session]:
+        with self._lock:
+            session = self._idle.pop() if self._idle else None
+        if session is None:
+            session = self._factory()
+        try:
+            yield session
+        finally:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(session)
+                    session = None
+            if session is not None:
+                session.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+
 class HiboutikAPI:
-    def __init__(self, account, user, api_key):
+    """Client of the Hiboutik API.
+
+    By default, all the requests go through the same session. With
+    `session_per_worker`, each concurrent request gets a session of its own
+    from a `SessionPool`."""
+
+    def __init__(
+        self,
+        account,
+        user,
+        api_key,
+        pool_maxsize=HIBOUTIK_DEFAULT_POOL_MAXSIZE,
+        scheduler: RequestScheduler = None,
+        timeout=HIBOUTIK_DEFAULT_TIMEOUT,
+        tracer: RequestTracer = None,
+        api_root: str = None,
+        session_per_worker=False,
+    ):
         self.account = account
         self.host = f"{account}.hiboutik.com"
         self.user = user
@@ -239,74 +500,199 @@ class HiboutikAPI:
 
         self.headers = {"Accept": "application/json"}
 
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        self.session = self._make_session(pool_maxsize)
+        self.session_pool = None
+        if session_per_worker:
+            # A worker sends one request at a time: one connection per session
+            self.session_pool = SessionPool(
+                lambda: self._make_session(pool_maxsize=1), max_idle=pool_maxsize
+            )
 
-        self.api_root = "https://{0}/api".format(self.host)
+        # `api_root` allows to target a stand-in server, e.g. for load testing
+        self.api_root = api_root or "https://{0}/api".format(self.host)
+
+        self.scheduler = scheduler or RequestScheduler()
+        self.timeout = timeout
+        self.metrics = HiboutikMetrics()
+        self.tracer = tracer or RequestTracer()
+
+        self._update_executor = None
+        self._update_executor_lock = threading.Lock()
+
+    def _make_session(self, pool_maxsize) -> requests.Session:
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.auth = HTTPBasicAuth(self.user, self.api_key)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @contextmanager
+    def _get_session(self) -> Iterator[requests.Session]:
+        if self.session_pool is None:
+            yield self.session
+        else:
+            with self.session_pool.session() as session:
+                yield session
+
+    def close(self):
+        self.session.close()
+        if self.session_pool is not None:
+            self.session_pool.close()
+        if self._update_executor is not None:
+            self._update_executor.shutdown(wait=False)
+
+    def _request(
+        self, method: str, endpoint: str, path_params: dict = None, **kwargs
+    ) -> requests.Response:
+        """Sends a request through the scheduler.
+        `endpoint` is a path template such as "product/{product_id}".
+        Timeouts are shortened to fit in the current `Deadline`, if any."""
+        url = f"{self.api_root}/{endpoint.format(**(path_params or {}))}"
+        metrics_key = f"{method.upper()} {endpoint}"
+        attempts = 0
+
+        def send():
+            nonlocal attempts
+            if attempts:
+                self.metrics.record_retry(metrics_key)
+            attempts += 1
+            started_at = time.monotonic()
+            try:
+                with self._get_session() as session:
+                    response = session.request(
+                        method, url, timeout=self._get_timeout(), **kwargs
+                    )
+            except requests.RequestException as e:
+                self.metrics.record(
+                    metrics_key, type(e).__name__, time.monotonic() - started_at
+                )
+                raise
+            self.metrics.record(
+                metrics_key,
+                response.status_code,
+                time.monotonic() - started_at,
+                bytes_sent=_size(response.request.body),
+                bytes_received=_size(response.content),
+            )
+            self.tracer.trace(method, url, kwargs.get("data"), response)
+            return response
+
+        try:
+            return self.scheduler.execute(method, send)
+        except (requests.Timeout, DeadlineExceededError) as e:
+            raise HiboutikTimeoutError(f"{method.upper()} {endpoint}: {e}")
+        except (requests.ConnectionError, CircuitOpenError) as e:
+            raise HiboutikUnavailableError(f"{method.upper()} {endpoint}: {e}")
+
+    def _get_timeout(self):
+        remaining = Deadline.remaining()
+        if remaining is None:
+            return self.timeout
+        if remaining <= 0:
+            raise DeadlineExceededError("Operation deadline exceeded")
+        connect, read = self.timeout
+        return min(connect, remaining), min(read, remaining)
 
     def get_products(self) -> List[Product]:
-        response = self.session.get(
-            f"{self.api_root}/products",
-            auth=HTTPBasicAuth(self.user, self.api_key),
-        )
-        LOGGER.debug(f"HIBOUTIK get products>{response.text}")
-        if response.status_code != 200:
-            raise HiboutikAPIError(response.json())
-        return list(map(lambda p: Product.create_from_data(p), response.json()))
+        return list(self.iter_products())
+
+    def iter_products(self) -> Iterator[Product]:
+        """Yields the products of the whole catalog, one page at a time.
+        Only the current page is held in memory."""
+        page = 1
+        previous_first_id = None
+        while True:
+            response = self._request(
+                "get", "products", params={HIBOUTIK_PAGE_PARAM: page}
+            )
+            if response.status_code != 200:
+                raise HiboutikAPIError(response.json())
+            data = response.json()
+            if not data or data[0]["product_id"] == previous_first_id:
+                # Past the last page, or the instance ignores pagination and repeats it
+                return
+            previous_first_id = data[0]["product_id"]
+            for product_data in data:
+                yield Product.create_from_data(product_data)
+            del data
+            page += 1
 
     def post_product(self, product: Product) -> int:
-        response = self.session.post(
-            f"{self.api_root}/products",
-            auth=HTTPBasicAuth(self.user, self.api_key),
-            data=product.data,
-        )
-        LOGGER.debug(f"HIBOUTIK post product>{response.text}")
+        response = self._request("post", "products", data=product.data)
         if response.status_code != 201:
             raise HiboutikAPIError(response.json())
         return response.json()["product_id"]
 
     def _put_product(self, product_id: int, data):
-        response = self.session.put(
-            f"{self.api_root}/product/{product_id}",
-            auth=HTTPBasicAuth(self.user, self.api_key),
-            data=data,
+        response = self._request(
+            "put", "product/{product_id}", {"product_id": product_id}, data=data
         )
-        LOGGER.debug(f"HIBOUTIK put product {product_id} {data}>{response.text}")
         if response.status_code != 200:
             raise HiboutikAPIError(response.json())
 
     def get_product(self, product_id: int):
-        response = self.session.get(
-            f"{self.api_root}/products/{product_id}",
-            auth=HTTPBasicAuth(self.user, self.api_key),
+        response = self._request(
+            "get", "products/{product_id}", {"product_id": product_id}
         )
-        LOGGER.debug(f"HIBOUTIK get product {product_id}>{response.text}")
         if response.status_code == 200:
             return Product.create_from_data(response.json()[0])
         else:
             raise HiboutikAPIError(response.json())
 
     def update_product(self, product_id: int, update: List[ProductAttribute]):
-        for pa in update:
-            self._put_product(product_id, pa.__dict__)
+        """Updates all the given attributes of a product, or raises.
+
+        Hiboutik takes a single attribute per PUT, so the calls are sent
+        concurrently. If any of them fails, HiboutikPartialUpdateError tells
+        which attributes were applied and which were not."""
+        if len(update) <= 1:
+            for pa in update:
+                self._put_product(product_id, pa.__dict__)
+            return
+
+        deadline = Deadline.current()
+        executor = self._get_update_executor()
+        futures = [
+            (pa, executor.submit(self._put_attribute, deadline, product_id, pa))
+            for pa in update
+        ]
+        applied, failed = [], {}
+        for pa, future in futures:
+            try:
+                future.result()
+                applied.append(pa.product_attribute)
+            except (Exception, HiboutikAPIError) as e:
+                failed[pa.product_attribute] = e
+        if failed:
+            raise HiboutikPartialUpdateError(product_id, applied, failed)
+
+    def _put_attribute(
+        self, deadline: Deadline, product_id: int, pa: ProductAttribute
+    ):
+        if deadline is None:
+            return self._put_product(product_id, pa.__dict__)
+        with deadline:
+            return self._put_product(product_id, pa.__dict__)
+
+    def _get_update_executor(self) -> ThreadPoolExecutor:
+        with self._update_executor_lock:
+            if self._update_executor is None:
+                self._update_executor = ThreadPoolExecutor(
+                    max_workers=len(ProductData.__dataclass_fields__),
+                    thread_name_prefix="hiboutik-update",
+                )
+            return self._update_executor
 
     def get_webhooks(self) -> List[Webhook]:
-        response = self.session.get(
-            f"{self.api_root}/webhooks",
-            auth=HTTPBasicAuth(self.user, self.api_key),
-        )
-        LOGGER.debug(f"HIBOUTIK get webhooks > {response.text}")
+        response = self._request("get", "webhooks")
         if response.status_code != 200:
             raise HiboutikAPIError(response.json())
         return list(map(lambda i: Webhook.create_from_data(i), response.json()))
 
     def post_webhook(self, data: dict) -> int:
-        response = self.session.post(
-            f"{self.api_root}/webhooks",
-            auth=HTTPBasicAuth(self.user, self.api_key),
-            data=data,
-        )
-        LOGGER.debug(f"HIBOUTIK post webhook\n{data}\n>\n{response.text}")
+        response = self._request("post", "webhooks", data=data)
         if response.status_code == 200:
             return response.json()["webhook_id"]
         elif response.status_code == 403:
@@ -315,11 +701,9 @@ class HiboutikAPI:
             raise HiboutikAPIError(response.json())
 
     def delete_webhook(self, webhook_id: int):
-        response = self.session.delete(
-            f"{self.api_root}/webhooks/{webhook_id}",
-            auth=HTTPBasicAuth(self.user, self.api_key),
+        response = self._request(
+            "delete", "webhooks/{webhook_id}", {"webhook_id": webhook_id}
         )
-        LOGGER.debug(f"HIBOUTIK delete webhook {webhook_id} >\n{response.text}")
         if response.status_code == 403:
             raise HiboutikAPIInsufficientRightsError(response.json())
         elif response.status_code != 200:
@@ -339,12 +723,7 @@ class HiboutikAPI:
 
     def post_inventory_input(self, inv_input: InventoryInputData) -> int:
         data = inv_input.__dict__.copy()
-        response = self.session.post(
-            f"{self.api_root}/inventory_inputs",
-            auth=HTTPBasicAuth(self.user, self.api_key),
-            data=data,
-        )
-        LOGGER.debug(f"HIBOUTIK post inventory input\n{data}\n>\n{response.text}")
+        response = self._request("post", "inventory_inputs", data=data)
         if response.status_code == 201:
             return response.json()["inventory_input_id"]
         else:
@@ -354,14 +733,12 @@ class HiboutikAPI:
         self, inv_input_id: int, inv_input_detail: InventoryInputDetailData
     ) -> int:
         data = inv_input_detail.__dict__.copy()
-        response = self.session.post(
-            f"{self.api_root}/inventory_input_details/{inv_input_id}",
-            auth=HTTPBasicAuth(self.user, self.api_key),
+        response = self._request(
+            "post",
+            "inventory_input_details/{inv_input_id}",
+            {"inv_input_id": inv_input_id},
             data=data,
         )
-        LOGGER.debug(
-            f"HIBOUTIK post inventory input detail\n{data}\n>\n{response.text}"
-        )
         if response.status_code == 201:
             return response.json()["inventory_input_detail_id"]
         else:
@@ -369,13 +746,66 @@ class HiboutikAPI:
 
     def validate_inventory_input(self, inventory_input_id: int):
         data = {"inventory_input_id": inventory_input_id}
-        response = self.session.post(
-            f"{self.api_root}/inventory_input_validate",
-            auth=HTTPBasicAuth(self.user, self.api_key),
-            data=data,
-        )
-        LOGGER.debug(
-            f"HIBOUTIK post inventory input validate\n{data}\n>\n{response.text}"
-        )
+        response = self._request("post", "inventory_input_validate", data=data)
         if response.status_code != 200:
             raise HiboutikAPIError(response.json())
+
+
+def _size(body) -> int:
+    if isinstance(body, str):
+        return len(body.encode())
+    if isinstance(body, bytes):
+        return len(body)
+    return 0
+
+
+class HiboutikAPIRegistry:
+    """Process-wide pool of long-lived `HiboutikAPI` clients, one per Hiboutik instance.
+
+    Clients keep their HTTP connections alive between calls. A client is rebuilt
+    only when its credentials or its `version` (e.g. the settings' modification
+    timestamp) change."""
+
+    def __init__(self, factory=HiboutikAPI):
+        self._factory = factory
+        self._clients: Dict[str, Tuple[tuple, HiboutikAPI]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, account, user, api_key, version=None, **options) -> HiboutikAPI:
+        """`options` are passed to the factory when the client is built."""
+        fingerprint = (user, api_key, version)
+        with self._lock:
+            entry = self._clients.get(account)
+            if entry is not None:
+                cached_fingerprint, api = entry
+                if cached_fingerprint == fingerprint:
+                    return api
+                api.close()
+            api = self._factory(
+                account=account, user=user, api_key=api_key, **options
+            )
+            self._clients[account] = (fingerprint, api)
+            return api
+
+    def clear(self):
+        with self._lock:
+            for _, api in self._clients.values():
+                api.close()
+            self._clients.clear()
+
+
+def make_pooled_api(
+    rate=DEFAULT_RATE, max_concurrency=DEFAULT_MAX_CONCURRENCY, **options
+) -> HiboutikAPI:
+    """Builds a client of the registry, sending at most `rate` requests per second
+    and `max_concurrency` at once. These bounds hold for the current process."""
+    scheduler = RequestScheduler(rate=rate, max_concurrency=max_concurrency)
+    return HiboutikAPI(scheduler=scheduler, session_per_worker=True, **options)
+
+
+API_REGISTRY = HiboutikAPIRegistry(make_pooled_api)
+
+
+def get_hiboutik_api(account, user, api_key, version=None, **options) -> HiboutikAPI:
+    """Returns the pooled client for this Hiboutik instance."""
+    return API_REGISTRY.get(account, user, api_key, version, **options)
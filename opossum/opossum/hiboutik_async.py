@@ -0,0 +1,181 @@
+import asyncio
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Callable, Iterable, List
+
+from opossum.opossum.hiboutik import (
+    HiboutikAPI,
+    HiboutikAPIError,
+    HiboutikAPIInsufficientRightsError,
+    HiboutikConnector,
+    InventoryInputBatch,
+    ProductCatalog,
+    is_up_to_date,
+)
+from opossum.opossum.models import Item
+from opossum.opossum.throttling import Deadline
+
+LOGGER = getLogger(__name__)
+
+#: Default number of Hiboutik operations in flight at once.
+DEFAULT_MAX_IN_FLIGHT = 8
+
+
+def _awaitable(name):
+    async def method(self, *args, **kwargs):
+        return await self.run(getattr(self.api, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = f"Awaitable `HiboutikAPI.{name}`."
+    return method
+
+
+class AsyncHiboutikAPI:
+    """Awaitable counterpart of `HiboutikAPI`.
+
+    Calls are run on a bounded pool of worker threads sharing the pooled
+    `HiboutikAPI`, so that at most `max_in_flight` of them wait on Hiboutik at
+    the same time. With a `session_per_worker` client, each worker has its own
+    session and keep-alive connection."""
+
+    def __init__(self, api: HiboutikAPI, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.api = api
+        self.max_in_flight = max_in_flight
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="hiboutik"
+        )
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs a blocking callable in one of the in-flight slots."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    def close(self):
+        """Releases the worker threads. The underlying pooled client is kept open."""
+        self._executor.shutdown(wait=True)
+
+    get_products = _awaitable("get_products")
+    post_product = _awaitable("post_product")
+    get_product = _awaitable("get_product")
+    update_product = _awaitable("update_product")
+    get_webhooks = _awaitable("get_webhooks")
+    post_webhook = _awaitable("post_webhook")
+    delete_webhook = _awaitable("delete_webhook")
+    post_inventory_input_for_product = _awaitable("post_inventory_input_for_product")
+    post_inventory_input = _awaitable("post_inventory_input")
+    post_inventory_input_details = _awaitable("post_inventory_input_details")
+    validate_inventory_input = _awaitable("validate_inventory_input")
+
+
+@dataclass
+class SyncResult:
+    item: Item
+    error: BaseException = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class AsyncHiboutikConnector:
+    """Syncs many items concurrently.
+
+    Each item goes through the regular `HiboutikConnector.sync` in its own
+    in-flight slot, so items are independent: a failing item is reported in its
+    `SyncResult` and does not stop the others. Each item sync can be bounded by
+    `item_deadline` seconds."""
+
+    def __init__(
+        self,
+        api: AsyncHiboutikAPI,
+        item_deadline: float = None,
+        catalog: ProductCatalog = None,
+        inventory: InventoryInputBatch = None,
+    ):
+        self.api = api
+        self.connector = HiboutikConnector(
+            api.api, catalog=catalog, inventory=inventory
+        )
+        self.item_deadline = item_deadline
+
+    def _sync_within_deadline(self, item: Item) -> Item:
+        if self.item_deadline is None:
+            return self.connector.sync(item)
+        with Deadline(self.item_deadline):
+            return self.connector.sync(item)
+
+    async def sync(self, item: Item) -> Item:
+        return await self.api.run(self._sync_within_deadline, item)
+
+    async def _sync_result(self, item: Item) -> SyncResult:
+        try:
+            return SyncResult(await self.sync(item))
+        except (Exception, HiboutikAPIError, HiboutikAPIInsufficientRightsError) as e:
+            LOGGER.warning(f"Could not sync item {item.code}: {e!r}")
+            return SyncResult(item, e)
+
+    async def sync_many(self, items: Iterable[Item]) -> List[SyncResult]:
+        """Returns one result per item, in the same order."""
+        return list(
+            await asyncio.gather(*(self._sync_result(item) for item in items))
+        )
+
+
+def sync_items(
+    api: HiboutikAPI,
+    items: List[Item],
+    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    item_deadline: float = None,
+    on_synced: Callable[[List[SyncResult]], None] = None,
+    catalog: ProductCatalog = None,
+) -> List[SyncResult]:
+    """Syncs a batch of items with as few Hiboutik calls as possible.
+
+    Up to date items are skipped. The catalog is loaded once to diff the other
+    items against, they are synced concurrently and their stock moves go in a
+    single inventory input. `on_synced` is called with the results once this
+    inventory input is validated, or failed to, so that new Hiboutik IDs are
+    stored either way. If validation failed, the fingerprints of the stocked
+    items are cleared as their stock was not applied.
+
+    An already loaded `catalog` can be given, it is kept up to date."""
+    if catalog is None and all(is_up_to_date(item) for item in items):
+        catalog = ProductCatalog()  # Not needed, don't call Hiboutik at all
+    elif catalog is None:
+        catalog = ProductCatalog.load(api)
+
+    async_api = AsyncHiboutikAPI(api, max_in_flight=max_in_flight)
+    try:
+        inventory = InventoryInputBatch(api)
+        connector = AsyncHiboutikConnector(
+            async_api,
+            item_deadline=item_deadline,
+            catalog=catalog,
+            inventory=inventory,
+        )
+        results = asyncio.run(connector.sync_many(items))
+
+        if item_deadline is None:
+            deadline = contextlib.nullcontext()
+        else:
+            deadline = Deadline(item_deadline)
+        try:
+            with deadline:
+                inventory.validate()
+        except BaseException:
+            for result in results:
+                if result.item.is_stock_item:
+                    result.item.fingerprint = ""
+            raise
+        finally:
+            if on_synced is not None:
+                on_synced(results)
+    finally:
+        async_api.close()
+
+    return results
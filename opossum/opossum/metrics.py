@@ -0,0 +1,97 @@
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Dict
+
+#: Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class EndpointMetrics:
+    """Counters of the calls made to one endpoint, such as "GET products"."""
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.statuses = Counter()
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def record(self, status, latency: float, bytes_sent: int, bytes_received: int):
+        self.calls += 1
+        self.statuses[str(status)] += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.latency_buckets[i] += 1
+                break
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "statuses": dict(self.statuses),
+            "latency_sum": self.latency_sum,
+            "latency_avg": self.latency_sum / self.calls if self.calls else 0.0,
+            "latency_max": self.latency_max,
+            "latency_histogram": {
+                str(bound): count
+                for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)
+            },
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+
+
+class HiboutikMetrics:
+    """Per-endpoint latency, status codes, traffic and retries of a Hiboutik client.
+
+    Every attempt sent to Hiboutik is recorded, a retried call counting for
+    one call per attempt."""
+
+    def __init__(self):
+        self._endpoints: Dict[str, EndpointMetrics] = {}
+        self._lock = threading.Lock()
+        self.since = datetime.now()
+
+    def _get(self, endpoint: str) -> EndpointMetrics:
+        if endpoint not in self._endpoints:
+            self._endpoints[endpoint] = EndpointMetrics()
+        return self._endpoints[endpoint]
+
+    def record(
+        self,
+        endpoint: str,
+        status,
+        latency: float,
+        bytes_sent: int = 0,
+        bytes_received: int = 0,
+    ):
+        """`status` is the HTTP status code, or the exception name if none came."""
+        with self._lock:
+            self._get(endpoint).record(status, latency, bytes_sent, bytes_received)
+
+    def record_retry(self, endpoint: str):
+        with self._lock:
+            self._get(endpoint).retries += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "since": self.since.isoformat(),
+                "endpoints": {
+                    endpoint: metrics.as_dict()
+                    for endpoint, metrics in sorted(self._endpoints.items())
+                },
+            }
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self.since = datetime.now()
@@ -15,6 +15,7 @@ class Item:
     deactivated: bool = False
     external_id: str = ""
     stock_qty: int = 0
+    fingerprint: str = ""  # Of the product data last pushed to the external POS
 
 
 @dataclass
@@ -24,7 +25,10 @@ class POSInvoiceItem:
     qty: int
     external_id: str
     code: str = ""
-    # TODO: add price and tax
+    # As sent by the external POS, empty when it did not
+    price: str = ""
+    tax_value: str = ""
+    discount: str = ""
 
 
 @dataclass
@@ -9,9 +9,9 @@ import frappe
 from .models import POSInvoice, POSInvoiceItem
 
 
-def get_or_create_opening_entry(user):
+def get_or_create_opening_entry(user, commit=True):
     """Given a user, make sure we have a POS Opening Entry.
-    Create one if necessary."""
+    Create one if necessary, committing it unless `commit` is False."""
 
     created = False
     open_entry = frappe.get_last_doc(
@@ -41,7 +41,8 @@ def get_or_create_opening_entry(user):
 
     open_entry.insert()
     open_entry.submit()
-    frappe.db.commit()
+    if commit:
+        frappe.db.commit()
 
     created = True
 
@@ -122,8 +123,9 @@ def get_item_price_on(item_code: str, transaction_date: str):
     return price_list_rate
 
 
-def make_pos_invoice(pos_invoice: POSInvoice, company, pos_profile, customer, default_income_account):
-    """Create a POS Invoice in the ERP from the external POS data"""
+def make_pos_invoice(pos_invoice: POSInvoice, company, pos_profile, customer, default_income_account, commit=True):
+    """Create a POS Invoice in the ERP from the external POS data.
+    With `commit` False, committing is left to the caller, e.g. to batch invoices."""
 
     pos_inv_doc = frappe.new_doc("POS Invoice")
 
@@ -167,6 +169,7 @@ def make_pos_invoice(pos_invoice: POSInvoice, company, pos_profile, customer, de
     pos_inv_doc.insert()
     pos_inv_doc.calculate_taxes_and_totals()
     pos_inv_doc.submit()
-    frappe.db.commit()
+    if commit:
+        frappe.db.commit()
 
     return pos_inv_doc
@@ -0,0 +1,317 @@
+"""A local stand-in for the Hiboutik API, to load test the connector offline.
+
+It implements the endpoints used by `HiboutikAPI`, keeps its catalog in
+memory and can add latency, server errors and 429 responses.
+
+Run it standalone with, for instance:
+
+    python -m opossum.opossum.tests.fake_hiboutik --latency 0.05 --throttle-rate 0.01
+
+then point a client to it:
+
+    HiboutikAPI(..., api_root="http://127.0.0.1:8765/api")
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+#: Number of products per page of the /products listing.
+DEFAULT_PAGE_SIZE = 250
+
+_INT_PRODUCT_FIELDS = {"product_vat", "product_arch", "product_stock_management"}
+
+
+class FakeHiboutik:
+    """State and behaviour of the stand-in, shared by the request handlers.
+
+    `latency` seconds (plus up to `latency_jitter`) are spent on each request.
+    `error_rate` and `throttle_rate` are the shares of requests answered with a
+    500 and a 429 (with a `retry_after` Retry-After header) respectively."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: float = 1,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        seed: int = None,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self._random = random.Random(seed)
+
+        self.products = {}
+        self.webhooks = {}
+        self.inventory_inputs = {}
+        #: Number of requests received, by "METHOD endpoint", e.g. "PUT product".
+        self.calls = Counter()
+
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def _new_id(self) -> int:
+        rv = self._next_id
+        self._next_id += 1
+        return rv
+
+    def add_product(self, product_model, product_price="0", product_vat=1, stock=0):
+        with self._lock:
+            product_id = self._new_id()
+            self.products[product_id] = {
+                "product_id": product_id,
+                "product_model": product_model,
+                "product_price": product_price,
+                "product_vat": product_vat,
+                "product_arch": 0,
+                "product_stock_management": 1 if stock else 0,
+                "stock_available": [{"stock_available": stock}],
+            }
+            return product_id
+
+    def handle(self, method: str, path: str, query: dict, form: dict):
+        """Returns (status, body, headers) for a request to an API path."""
+        endpoint = path.strip("/").split("/")[0]
+        with self._lock:
+            self.calls[f"{method} {endpoint}"] += 1
+            draw = self._random.random()
+            delay = self.latency + self._random.random() * self.latency_jitter
+
+        if delay:
+            time.sleep(delay)
+
+        if draw < self.throttle_rate:
+            headers = {"Retry-After": str(self.retry_after)}
+            return 429, {"error": "Too many requests"}, headers
+        if draw < self.throttle_rate + self.error_rate:
+            return 500, {"error": "Internal error"}, {}
+
+        with self._lock:
+            return self._route(method, path, query, form)
+
+    def _route(self, method, path, query, form):
+        for pattern, route_method, handler in self._routes():
+            match = re.fullmatch(pattern, path)
+            if match and method == route_method:
+                return handler(*match.groups(), query=query, form=form)
+        return 404, {"error": f"No route for {method} {path}"}, {}
+
+    def _routes(self):
+        return [
+            (r"/products/?", "GET", self._get_products),
+            (r"/products/?", "POST", self._post_product),
+            (r"/products/(\d+)/?", "GET", self._get_product),
+            (r"/product/(\d+)/?", "PUT", self._put_product),
+            (r"/webhooks/?", "GET", self._get_webhooks),
+            (r"/webhooks/?", "POST", self._post_webhook),
+            (r"/webhooks/(\d+)/?", "DELETE", self._delete_webhook),
+            (r"/inventory_inputs/?", "POST", self._post_inventory_input),
+            (
+                r"/inventory_input_details/(\d+)/?",
+                "POST",
+                self._post_inventory_detail,
+            ),
+            (
+                r"/inventory_input_validate/?",
+                "POST",
+                self._validate_inventory_input,
+            ),
+        ]
+
+    def _get_products(self, query, form):
+        page = int(query.get("p", 1))
+        products = list(self.products.values())
+        start = (page - 1) * self.page_size
+        return 200, products[start : start + self.page_size], {}
+
+    def _post_product(self, query, form):
+        product_id = self._new_id()
+        product = {
+            "product_id": product_id,
+            "product_model": form.get("product_model", ""),
+            "product_price": form.get("product_price", "0"),
+            "stock_available": [{"stock_available": 0}],
+        }
+        for field in _INT_PRODUCT_FIELDS:
+            product[field] = int(form.get(field, 0))
+        self.products[product_id] = product
+        return 201, {"product_id": product_id}, {}
+
+    def _get_product(self, product_id, query, form):
+        product = self.products.get(int(product_id))
+        if product is None:
+            return 404, {"error": "Product not found"}, {}
+        return 200, [product], {}
+
+    def _put_product(self, product_id, query, form):
+        product = self.products.get(int(product_id))
+        if product is None:
+            return 404, {"error": "Product not found"}, {}
+        attribute, value = form["product_attribute"], form["new_value"]
+        product[attribute] = int(value) if attribute in _INT_PRODUCT_FIELDS else value
+        return 200, {"product_id": product["product_id"]}, {}
+
+    def _get_webhooks(self, query, form):
+        return 200, list(self.webhooks.values()), {}
+
+    def _post_webhook(self, query, form):
+        webhook_id = self._new_id()
+        self.webhooks[webhook_id] = dict(form, webhook_id=webhook_id)
+        return 200, {"webhook_id": webhook_id}, {}
+
+    def _delete_webhook(self, webhook_id, query, form):
+        if self.webhooks.pop(int(webhook_id), None) is None:
+            return 404, {"error": "Webhook not found"}, {}
+        return 200, {}, {}
+
+    def _post_inventory_input(self, query, form):
+        inventory_input_id = self._new_id()
+        self.inventory_inputs[inventory_input_id] = {
+            "details": [],
+            "validated": False,
+        }
+        return 201, {"inventory_input_id": inventory_input_id}, {}
+
+    def _post_inventory_detail(self, inventory_input_id, query, form):
+        inventory_input = self.inventory_inputs.get(int(inventory_input_id))
+        if inventory_input is None or inventory_input["validated"]:
+            return 400, {"error": "Invalid inventory input"}, {}
+        detail_id = self._new_id()
+        inventory_input["details"].append(
+            (int(form["product_id"]), int(float(form["quantity"])))
+        )
+        return 201, {"inventory_input_detail_id": detail_id}, {}
+
+    def _validate_inventory_input(self, query, form):
+        inventory_input = self.inventory_inputs.get(int(form["inventory_input_id"]))
+        if inventory_input is None or inventory_input["validated"]:
+            return 400, {"error": "Invalid inventory input"}, {}
+        for product_id, quantity in inventory_input["details"]:
+            product = self.products.get(product_id)
+            if product is not None:
+                product["stock_available"][0]["stock_available"] += quantity
+        inventory_input["validated"] = True
+        return 200, {}, {}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the real service
+    # Headers and body are written separately: don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else ""
+        form = {k: v[0] for k, v in parse_qs(body).items()}
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path[len("/api") :] if url.path.startswith("/api") else url.path
+
+        status, data, headers = self.server.hiboutik.handle(
+            self.command, path, query, form
+        )
+
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeHiboutikServer:
+    """Serves a `FakeHiboutik` on a local port from a background thread.
+
+    Used as a context manager:
+
+        with FakeHiboutikServer(latency=0.01) as server:
+            api = HiboutikAPI("shop", "user", "key", api_root=server.api_root)
+    """
+
+    def __init__(
+        self, hiboutik: FakeHiboutik = None, host="127.0.0.1", port=0, **kwargs
+    ):
+        self.hiboutik = hiboutik or FakeHiboutik(**kwargs)
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.hiboutik = self.hiboutik
+        self._thread = None
+
+    @property
+    def api_root(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def serve_forever(self):
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, args=(0.05,), daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    server = FakeHiboutikServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        page_size=args.page_size,
+    )
+    print(f"Fake Hiboutik listening on {server.api_root}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+from unittest import TestCase
+
+from opossum.opossum.hiboutik import (
+    HiboutikAPI,
+    HiboutikAPIError,
+    HiboutikConnector,
+    ProductAttribute,
+    Webhook,
+)
+from opossum.opossum.hiboutik_async import sync_items
+from opossum.opossum.models import Item
+from opossum.opossum.tests.fake_hiboutik import FakeHiboutikServer
+from opossum.opossum.throttling import RequestScheduler
+
+
+class FakeHiboutikTestCase(TestCase):
+    server_options = {}
+
+    def setUp(self) -> None:
+        self.server = FakeHiboutikServer(seed=1, **self.server_options).start()
+        self.hiboutik = self.server.hiboutik
+        self.api = HiboutikAPI(
+            "shop",
+            "user",
+            "key",
+            api_root=self.server.api_root,
+            scheduler=RequestScheduler(rate=1000, burst=1000, backoff=0.01),
+        )
+
+    def tearDown(self) -> None:
+        self.api.close()
+        self.server.stop()
+
+
+class ClientAgainstFakeHiboutikTestCase(FakeHiboutikTestCase):
+    server_options = {"page_size": 2}
+
+    def test_product_lifecycle(self):
+        item = Item(
+            code="spoon",
+            name="Spoon",
+            price="2.5",
+            vat=1,
+            is_stock_item=True,
+            stock_qty=4,
+        )
+        connector = HiboutikConnector(self.api)
+
+        connector.sync(item)
+        item.price = "3.0"
+        item.stock_qty = 6
+        connector.sync(item)
+
+        product = self.api.get_product(item.external_id)
+        self.assertEqual(product.product_model, "Spoon")
+        self.assertEqual(product.product_price, "3.0")
+        self.assertEqual(product.stock_available[0].stock_available, 6)
+
+    def test_products_are_paginated(self):
+        for n in range(5):
+            self.hiboutik.add_product(f"Product {n}")
+
+        products = list(self.api.iter_products())
+
+        self.assertEqual(len(products), 5)
+        self.assertEqual(self.hiboutik.calls["GET products"], 4)
+
+    def test_update_product(self):
+        product_id = self.hiboutik.add_product("Fork", product_price="1.0")
+
+        self.api.update_product(
+            product_id,
+            [
+                ProductAttribute("product_model", "Big fork"),
+                ProductAttribute("product_vat", "2"),
+            ],
+        )
+
+        product = self.hiboutik.products[product_id]
+        self.assertEqual(product["product_model"], "Big fork")
+        self.assertEqual(product["product_vat"], 2)
+
+    def test_sale_webhook(self):
+        connector = HiboutikConnector(self.api)
+
+        connector.set_sale_webhook(Webhook.create_connector_webhook("http://a/hook"))
+        connector.set_sale_webhook(Webhook.create_connector_webhook("http://b/hook"))
+
+        webhooks = self.api.get_webhooks()
+        self.assertEqual([wh.webhook_url for wh in webhooks], ["http://b/hook"])
+
+    def test_unknown_product(self):
+        with self.assertRaises(HiboutikAPIError):
+            self.api.get_product(404)
+
+
+def make_items(count):
+    return [
+        Item(
+            code=f"item-{n}",
+            name=f"Item {n}",
+            price="1.0",
+            vat=1,
+            is_stock_item=True,
+            stock_qty=n,
+        )
+        for n in range(1, count + 1)
+    ]
+
+
+class SyncItemsTestCase(FakeHiboutikTestCase):
+    def test_new_catalog(self):
+        items = make_items(10)
+        saved = []
+
+        results = sync_items(self.api, items, max_in_flight=4, on_synced=saved.extend)
+
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(len(saved), 10)
+        for item in items:
+            product = self.hiboutik.products[int(item.external_id)]
+            stock = product["stock_available"][0]["stock_available"]
+            self.assertEqual(stock, item.stock_qty)
+        self.assertEqual(self.hiboutik.calls["POST inventory_inputs"], 1)
+        self.assertEqual(self.hiboutik.calls["POST inventory_input_validate"], 1)
+
+    def test_unchanged_catalog_is_not_written(self):
+        items = make_items(10)
+        sync_items(self.api, items)
+        self.hiboutik.calls.clear()
+        for item in items:
+            item.fingerprint = ""
+
+        sync_items(self.api, items)
+
+        self.assertEqual(set(self.hiboutik.calls), {"GET products"})
+
+    def test_up_to_date_catalog_costs_no_call(self):
+        items = make_items(10)
+        sync_items(self.api, items)
+        self.hiboutik.calls.clear()
+
+        results = sync_items(self.api, items)
+
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(sum(self.hiboutik.calls.values()), 0)
+
+    def test_only_changed_items_are_synced(self):
+        items = make_items(10)
+        sync_items(self.api, items)
+        self.hiboutik.calls.clear()
+        items[0].price = "2.0"
+
+        sync_items(self.api, items)
+
+        self.assertEqual(self.hiboutik.calls["PUT product"], 1)
+
+
+class SessionPerWorkerTestCase(FakeHiboutikTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.api.close()
+        self.api = HiboutikAPI(
+            "shop",
+            "user",
+            "key",
+            api_root=self.server.api_root,
+            pool_maxsize=4,
+            scheduler=RequestScheduler(rate=1000, burst=1000, backoff=0.01),
+            session_per_worker=True,
+        )
+
+    def test_sync_items(self):
+        items = make_items(20)
+
+        results = sync_items(self.api, items, max_in_flight=4)
+
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(len(self.hiboutik.products), 20)
+        self.assertLessEqual(len(self.api.session_pool._idle), 4)
+
+
+class ThrottlingFakeHiboutikTestCase(FakeHiboutikTestCase):
+    server_options = {"throttle_rate": 0.3, "retry_after": 0.01}
+
+    def test_throttled_requests_are_retried(self):
+        for n in range(10):
+            webhook = Webhook.create_connector_webhook(f"http://{n}/hook")
+            self.api.post_webhook(webhook.data)
+
+        self.assertEqual(len(self.hiboutik.webhooks), 10)
+        self.assertGreater(self.hiboutik.calls["POST webhooks"], 10)
@@ -5,19 +5,32 @@ from unittest import TestCase
 from unittest.mock import Mock
 
 import pytest
+import requests
 
 from opossum.opossum.doctype.hiboutik_settings.utils import (
     convert_payload_to_POS_invoice,
 )
 from opossum.opossum.hiboutik import (
+    HiboutikAPI,
+    HiboutikAPIError,
+    HiboutikAPIRegistry,
+    HiboutikPartialUpdateError,
+    HiboutikTimeoutError,
+    HiboutikUnavailableError,
     HiboutikConnector,
     Product,
     ProductStock,
+    InventoryInputBatch,
     ProductAttribute,
+    ProductCatalog,
     Webhook,
     ProductData,
+    SessionPool,
     SyncedItem,
     StockSyncer,
+    fingerprint,
+    is_up_to_date,
+    make_pooled_api,
 )
 from opossum.opossum.models import Item
 
@@ -141,6 +154,127 @@ class SyncItemTestCase(TestCase):
             ],
         )
 
+    def test_sync_records_fingerprint(self):
+        self.api.get_product.return_value = self.product
+
+        self.connector.sync(self.item)
+
+        self.assertEqual(self.item.fingerprint, fingerprint(self.item))
+        self.assertTrue(is_up_to_date(self.item))
+
+    def test_up_to_date_item_is_skipped(self):
+        self.item.fingerprint = fingerprint(self.item)
+
+        self.connector.sync(self.item)
+
+        self.assertEqual(self.api.mock_calls, [])
+
+    def test_changed_item_is_synced(self):
+        self.api.get_product.return_value = self.product
+        self.item.fingerprint = fingerprint(self.item)
+        self.item.price = "11.00"
+
+        self.connector.sync(self.item)
+
+        self.api.update_product.assert_called_once_with(
+            "42", [ProductAttribute("product_price", "11.00")]
+        )
+
+    def test_fingerprint_covers_stock(self):
+        self.item.is_stock_item = True
+        before = fingerprint(self.item)
+        self.item.stock_qty = 1
+
+        self.assertNotEqual(fingerprint(self.item), before)
+
+
+class CatalogSyncTestCase(TestCase):
+    def setUp(self) -> None:
+        self.api = Mock(name="mocked_api")
+        self.item = Item(
+            code="large-spoon",
+            name="Spoon (large)",
+            price="10.00",
+            vat=1,
+            is_stock_item=True,
+            external_id="42",
+            stock_qty=3,
+        )
+        self.product = Product(
+            product_id=42,
+            stock_available=[ProductStock(stock_available=3)],
+            **ProductData.create(self.item).data
+        )
+        self.catalog = ProductCatalog([self.product])
+        self.connector = HiboutikConnector(self.api, catalog=self.catalog)
+
+    def test_diff_uses_catalog(self):
+        self.item.price = "12.00"
+
+        self.connector.sync(self.item)
+
+        self.api.get_product.assert_not_called()
+        self.api.update_product.assert_called_once_with(
+            "42", [ProductAttribute("product_price", "12.00")]
+        )
+        self.api.post_inventory_input_for_product.assert_not_called()
+
+    def test_catalog_is_updated_from_writes(self):
+        self.item.price = "12.00"
+        self.item.stock_qty = 5
+
+        self.connector.sync(self.item)
+        self.item.fingerprint = ""
+        self.connector.sync(self.item)
+
+        self.assertEqual(self.catalog.get(42).product_price, "12.00")
+        self.assertEqual(self.catalog.get(42).stock_available[0].stock_available, 5)
+        self.api.post_inventory_input_for_product.assert_called_once()
+        self.assertEqual(self.api.update_product.call_args_list[1][0][1], [])
+
+    def test_unknown_product_falls_back_to_api(self):
+        self.item.external_id = "43"
+        self.api.get_product.return_value = Product(
+            product_id=43, stock_available=[], **ProductData.create(self.item).data
+        )
+
+        self.connector.sync(self.item)
+
+        self.api.get_product.assert_called_once_with("43")
+        self.assertIsNotNone(self.catalog.get(43))
+
+    def test_find_orphan(self):
+        self.item.external_id = ""
+
+        self.assertIs(self.catalog.find_orphan(self.item, set()), self.product)
+        self.assertIsNone(self.catalog.find_orphan(self.item, {"42"}))
+
+    def test_catalog_is_stored_as_data(self):
+        catalog = ProductCatalog.from_data(self.catalog.to_data())
+
+        self.assertEqual(catalog.get(42), self.product)
+
+    def test_stocked_products_can_be_left_out_of_data(self):
+        fork = Item(code="fork", name="Fork", price="1", vat=1, is_stock_item=False)
+        self.catalog.put(
+            Product(
+                product_id=43, stock_available=[], **ProductData.create(fork).data
+            )
+        )
+
+        catalog = ProductCatalog.from_data(self.catalog.to_data(stocked=False))
+
+        self.assertIsNone(catalog.get(42))
+        self.assertIsNotNone(catalog.get(43))
+
+    def test_created_product_is_recorded(self):
+        self.item.external_id = ""
+        self.api.post_product.return_value = 50
+
+        self.connector.sync(self.item)
+
+        self.assertEqual(self.catalog.get(50).product_model, self.item.name)
+
 
 class StockSyncerTestCase(TestCase):
     def setUp(self) -> None:
@@ -220,6 +354,49 @@ class StockSyncerTestCase(TestCase):
         )
 
 
+class InventoryInputBatchTestCase(TestCase):
+    def setUp(self) -> None:
+        self.api = Mock(name="mocked_api")
+        self.api.post_inventory_input.return_value = 7
+        self.inventory = InventoryInputBatch(self.api)
+        self.connector = HiboutikConnector(self.api, inventory=self.inventory)
+
+    def make_item(self, external_id, stock_qty):
+        item = Item(
+            code=f"item-{external_id}",
+            name=f"Item {external_id}",
+            price="1.00",
+            vat=1,
+            is_stock_item=True,
+            external_id=external_id,
+            stock_qty=stock_qty,
+        )
+        self.api.get_product.return_value = Product(
+            product_id=int(external_id),
+            stock_available=[ProductStock(stock_available=2)],
+            **ProductData.create(item).data
+        )
+        return item
+
+    def test_one_inventory_input_for_many_items(self):
+        for external_id in ["1", "2", "3"]:
+            self.connector.sync(self.make_item(external_id, stock_qty=5))
+        self.inventory.validate()
+
+        self.api.post_inventory_input.assert_called_once()
+        self.assertEqual(self.api.post_inventory_input_details.call_count, 3)
+        self.api.validate_inventory_input.assert_called_once_with(7)
+        self.api.post_inventory_input_for_product.assert_not_called()
+        self.assertEqual(self.inventory.lines, 3)
+
+    def test_nothing_to_validate_without_stock_move(self):
+        self.connector.sync(self.make_item("1", stock_qty=2))
+        self.inventory.validate()
+
+        self.api.post_inventory_input.assert_not_called()
+        self.api.validate_inventory_input.assert_not_called()
+
+
 class SetSaleWebhookTestCase(TestCase):
     def setUp(self) -> None:
         self.api = Mock(name="mocked_api")
@@ -299,6 +476,198 @@ class SetSaleWebhookTestCase(TestCase):
         self.assertFalse(self.api.delete_webhook.called)
 
 
+class HiboutikAPIRegistryTestCase(TestCase):
+    def setUp(self) -> None:
+        self.factory = Mock(name="api_factory", side_effect=lambda **kw: Mock(**kw))
+        self.registry = HiboutikAPIRegistry(factory=self.factory)
+
+    def test_client_is_reused(self):
+        api1 = self.registry.get("shop", "user", "key", version="v1")
+        api2 = self.registry.get("shop", "user", "key", version="v1")
+
+        self.assertIs(api1, api2)
+        self.factory.assert_called_once()
+
+    def test_client_is_rebuilt_when_settings_change(self):
+        api1 = self.registry.get("shop", "user", "key", version="v1")
+        api2 = self.registry.get("shop", "user", "key", version="v2")
+
+        self.assertIsNot(api1, api2)
+        api1.close.assert_called_once()
+
+    def test_one_client_per_instance(self):
+        api1 = self.registry.get("shop1", "user", "key")
+        api2 = self.registry.get("shop2", "user", "key")
+
+        self.assertIsNot(api1, api2)
+        api1.close.assert_not_called()
+
+
+class SessionPoolTestCase(TestCase):
+    def setUp(self) -> None:
+        self.factory = Mock(name="session_factory", side_effect=lambda: Mock())
+        self.pool = SessionPool(self.factory, max_idle=1)
+
+    def test_idle_session_is_reused(self):
+        with self.pool.session() as session1:
+            pass
+        with self.pool.session() as session2:
+            pass
+
+        self.assertIs(session1, session2)
+        self.factory.assert_called_once()
+
+    def test_concurrent_requests_get_their_own_session(self):
+        with self.pool.session() as session1:
+            with self.pool.session() as session2:
+                self.assertIsNot(session1, session2)
+
+        session1.close.assert_called_once()
+        session2.close.assert_not_called()
+
+    def test_registry_options_are_passed_to_the_factory(self):
+        factory = Mock(name="api_factory")
+        registry = HiboutikAPIRegistry(factory=factory)
+
+        registry.get("shop", "user", "key", pool_maxsize=4)
+
+        self.assertEqual(factory.call_args[1]["pool_maxsize"], 4)
+
+    def test_pooled_api_is_throttled_as_given(self):
+        api = make_pooled_api(
+            account="shop", user="user", api_key="key", rate=50, max_concurrency=32
+        )
+
+        self.assertEqual(api.scheduler.bucket.rate, 50)
+        self.assertEqual(api.scheduler.limiter.maximum, 32)
+        api.close()
+
+
+class HiboutikAPIRequestTestCase(TestCase):
+    def setUp(self) -> None:
+        self.api = HiboutikAPI("shop", "user", "key")
+        self.api.session = Mock(name="mocked_session")
+
+    def test_timeout_is_always_passed(self):
+        self.api.session.request.return_value = Mock(status_code=200, headers={})
+
+        self.api._request("get", "products")
+
+        _, kwargs = self.api.session.request.call_args
+        self.assertEqual(kwargs["timeout"], self.api.timeout)
+
+    def test_timeout_is_reported_as_api_error(self):
+        self.api.session.request.side_effect = requests.ReadTimeout()
+
+        with self.assertRaises(HiboutikTimeoutError):
+            self.api.get_webhooks()
+
+    def test_connection_error_is_reported_as_unavailable(self):
+        self.api.session.request.side_effect = requests.ConnectionError()
+
+        with self.assertRaises(HiboutikUnavailableError):
+            self.api.get_webhooks()
+
+
+class UpdateProductTestCase(TestCase):
+    def setUp(self) -> None:
+        self.api = HiboutikAPI("shop", "user", "key")
+        self.api._put_product = Mock(name="mocked_put_product")
+        self.update = [
+            ProductAttribute("product_model", "Spoon"),
+            ProductAttribute("product_price", "12.0"),
+            ProductAttribute("product_vat", "2"),
+        ]
+
+    def tearDown(self) -> None:
+        self.api.close()
+
+    def test_all_attributes_are_sent(self):
+        self.api.update_product(42, self.update)
+
+        self.assertEqual(self.api._put_product.call_count, 3)
+        sent = [call[0][1] for call in self.api._put_product.call_args_list]
+        for pa in self.update:
+            self.assertIn(pa.__dict__, sent)
+
+    def test_partial_failure_is_reported_once(self):
+        def put_product(product_id, data):
+            if data["product_attribute"] == "product_price":
+                raise HiboutikAPIError("boom")
+
+        self.api._put_product.side_effect = put_product
+
+        with self.assertRaises(HiboutikPartialUpdateError) as context:
+            self.api.update_product(42, self.update)
+
+        self.assertEqual(list(context.exception.failed), ["product_price"])
+        self.assertEqual(
+            sorted(context.exception.applied), ["product_model", "product_vat"]
+        )
+
+    def test_nothing_to_update(self):
+        self.api.update_product(42, [])
+
+        self.api._put_product.assert_not_called()
+
+
+def make_product_data(product_id):
+    return {
+        "product_id": product_id,
+        "product_model": f"Product {product_id}",
+        "product_price": "1.00",
+        "product_vat": 1,
+        "product_arch": 0,
+        "product_stock_management": 0,
+        "stock_available": [],
+    }
+
+
+class IterProductsTestCase(TestCase):
+    def setUp(self) -> None:
+        self.api = HiboutikAPI("shop", "user", "key")
+        self.api.session = Mock(name="mocked_session")
+
+    def set_pages(self, pages):
+        def request(method, url, params, **kwargs):
+            page = params["p"]
+            data = pages[page - 1] if page <= len(pages) else []
+            return Mock(status_code=200, headers={}, content=b"", json=lambda: data)
+
+        self.api.session.request.side_effect = request
+
+    def test_walks_all_pages(self):
+        self.set_pages(
+            [
+                [make_product_data(1), make_product_data(2)],
+                [make_product_data(3)],
+            ]
+        )
+
+        products = list(self.api.iter_products())
+
+        self.assertEqual([p.product_id for p in products], [1, 2, 3])
+        self.assertEqual(self.api.session.request.call_count, 3)
+
+    def test_pages_are_fetched_lazily(self):
+        self.set_pages([[make_product_data(1)], [make_product_data(2)]])
+
+        first = next(self.api.iter_products())
+
+        self.assertEqual(first.product_id, 1)
+        self.api.session.request.assert_called_once()
+
+    def test_stops_when_pagination_is_ignored(self):
+        page = [make_product_data(1), make_product_data(2)]
+        self.api.session.request.return_value = Mock(
+            status_code=200, headers={}, content=b"", json=lambda: page
+        )
+
+        products = self.api.get_products()
+
+        self.assertEqual(len(products), 2)
+
+
 def test_pos_utils_convert_sale_to_invoice():
     payload = {
         "completed_at": "2021-04-26 15:06:34",
@@ -318,3 +687,25 @@ def test_pos_utils_convert_sale_to_invoice():
     item2 = pos_invoice.invoice_items[1]
     assert item2.external_id == "37"
     assert item2.qty == 1
+
+
+def test_pos_utils_convert_sale_to_invoice_reads_line_prices():
+    payload = {
+        "completed_at": "2021-04-26 15:06:34",
+        "line_items[1][product_id]": "37",
+        "line_items[1][quantity]": "1",
+        "line_items[0][product_id]": "3",
+        "line_items[0][quantity]": "2",
+        "line_items[0][product_price]": "4.50",
+        "line_items[0][tax_value]": "0.055",
+        "line_items[0][discount]": "0.50",
+        "line_items[3][product_id]": "12",  # After a missing line
+        "line_items[3][quantity]": "1",
+    }
+
+    pos_invoice = convert_payload_to_POS_invoice(payload)
+
+    assert [i.external_id for i in pos_invoice.invoice_items] == ["3", "37"]
+    item1 = pos_invoice.invoice_items[0]
+    assert (item1.price, item1.tax_value, item1.discount) == ("4.50", "0.055", "0.50")
+    assert pos_invoice.invoice_items[1].price == ""
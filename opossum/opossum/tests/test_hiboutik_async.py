@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock
+
+from opossum.opossum.hiboutik import HiboutikAPIError, Product, ProductData
+from opossum.opossum.hiboutik_async import (
+    AsyncHiboutikAPI,
+    AsyncHiboutikConnector,
+    sync_items,
+)
+from opossum.opossum.models import Item
+
+
+def make_item(n, external_id=""):
+    return Item(
+        code=f"item-{n}",
+        name=f"Item {n}",
+        price="1.00",
+        vat=1,
+        is_stock_item=False,
+        external_id=external_id,
+    )
+
+
+class AsyncHiboutikAPITestCase(TestCase):
+    def setUp(self) -> None:
+        self.api = Mock(name="mocked_api")
+        self.async_api = AsyncHiboutikAPI(self.api, max_in_flight=2)
+
+    def tearDown(self) -> None:
+        self.async_api.close()
+
+    def test_calls_are_forwarded(self):
+        self.api.post_product.return_value = 35
+
+        rv = asyncio.run(self.async_api.post_product("a product"))
+
+        self.assertEqual(rv, 35)
+        self.api.post_product.assert_called_once_with("a product")
+
+    def test_in_flight_calls_are_bounded(self):
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+
+        def slow_get_product(product_id):
+            with lock:
+                in_flight.append(product_id)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.02)
+            with lock:
+                in_flight.remove(product_id)
+
+        self.api.get_product.side_effect = slow_get_product
+
+        async def run():
+            await asyncio.gather(*(self.async_api.get_product(i) for i in range(6)))
+
+        asyncio.run(run())
+
+        self.assertEqual(self.api.get_product.call_count, 6)
+        self.assertLessEqual(max(max_in_flight), 2)
+
+
+class AsyncHiboutikConnectorTestCase(TestCase):
+    def setUp(self) -> None:
+        self.api = Mock(name="mocked_api")
+        self.async_api = AsyncHiboutikAPI(self.api, max_in_flight=4)
+        self.connector = AsyncHiboutikConnector(self.async_api)
+
+    def tearDown(self) -> None:
+        self.async_api.close()
+
+    def test_sync_many_creates_products(self):
+        self.api.post_product.side_effect = [10, 11, 12]
+        items = [make_item(n) for n in range(3)]
+
+        results = asyncio.run(self.connector.sync_many(items))
+
+        self.assertEqual([r.item for r in results], items)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(
+            sorted(r.item.external_id for r in results), ["10", "11", "12"]
+        )
+
+    def test_sync_many_isolates_failures(self):
+        ok_item = make_item(1, external_id="1")
+        failing_item = make_item(2, external_id="2")
+
+        def get_product(product_id):
+            if product_id == "2":
+                raise HiboutikAPIError("boom")
+            return Product(
+                product_id=1, stock_available=[], **ProductData.create(ok_item).data
+            )
+
+        self.api.get_product.side_effect = get_product
+
+        results = asyncio.run(self.connector.sync_many([ok_item, failing_item]))
+
+        self.assertTrue(results[0].ok)
+        self.assertFalse(results[1].ok)
+        self.assertIsInstance(results[1].error, HiboutikAPIError)
+
+
+class SyncItemsTestCase(TestCase):
+    def setUp(self) -> None:
+        self.api = Mock(name="mocked_api")
+        self.api.iter_products.return_value = []
+        self.api.post_product.side_effect = [10, 11]
+        self.api.post_inventory_input.return_value = 1
+
+    def test_failed_validation_clears_stock_fingerprints(self):
+        self.api.validate_inventory_input.side_effect = HiboutikAPIError("boom")
+        stocked = make_item(1)
+        stocked.is_stock_item = True
+        stocked.stock_qty = 3
+        not_stocked = make_item(2)
+        saved = []
+
+        with self.assertRaises(HiboutikAPIError):
+            sync_items(self.api, [stocked, not_stocked], on_synced=saved.extend)
+
+        self.assertEqual(len(saved), 2)
+        self.assertEqual(stocked.external_id, "10")
+        self.assertEqual(stocked.fingerprint, "")
+        self.assertNotEqual(not_stocked.fingerprint, "")
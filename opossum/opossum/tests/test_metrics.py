@@ -0,0 +1,81 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+import requests
+
+from opossum.opossum.hiboutik import HiboutikAPI, HiboutikTimeoutError
+from opossum.opossum.metrics import HiboutikMetrics
+
+
+class HiboutikMetricsTestCase(TestCase):
+    def setUp(self) -> None:
+        self.metrics = HiboutikMetrics()
+
+    def test_record(self):
+        self.metrics.record("GET products", 200, 0.3, bytes_received=100)
+        self.metrics.record("GET products", 200, 0.7, bytes_received=50)
+        self.metrics.record("GET products", 500, 12.0)
+        self.metrics.record_retry("GET products")
+
+        endpoint = self.metrics.snapshot()["endpoints"]["GET products"]
+
+        self.assertEqual(endpoint["calls"], 3)
+        self.assertEqual(endpoint["retries"], 1)
+        self.assertEqual(endpoint["statuses"], {"200": 2, "500": 1})
+        self.assertEqual(endpoint["bytes_received"], 150)
+        self.assertEqual(endpoint["latency_max"], 12.0)
+        self.assertEqual(endpoint["latency_histogram"]["0.5"], 1)
+        self.assertEqual(endpoint["latency_histogram"]["1.0"], 1)
+        self.assertEqual(endpoint["latency_histogram"]["inf"], 1)
+
+    def test_reset(self):
+        self.metrics.record("GET products", 200, 0.3)
+
+        self.metrics.reset()
+
+        self.assertEqual(self.metrics.snapshot()["endpoints"], {})
+
+
+class HiboutikAPIMetricsTestCase(TestCase):
+    def setUp(self) -> None:
+        self.api = HiboutikAPI("shop", "user", "key")
+        self.api.session = Mock(name="mocked_session")
+
+    def test_calls_are_recorded_per_endpoint_template(self):
+        self.api.session.request.return_value = Mock(
+            status_code=200,
+            headers={},
+            content=b"{}",
+            request=Mock(body="product_attribute=product_vat&new_value=1"),
+        )
+
+        self.api._put_product(1, {})
+        self.api._put_product(2, {})
+
+        endpoints = self.api.metrics.snapshot()["endpoints"]
+        self.assertEqual(list(endpoints), ["PUT product/{product_id}"])
+        self.assertEqual(endpoints["PUT product/{product_id}"]["calls"], 2)
+        self.assertEqual(endpoints["PUT product/{product_id}"]["bytes_sent"], 82)
+        self.assertEqual(endpoints["PUT product/{product_id}"]["bytes_received"], 4)
+
+    def test_failures_are_recorded(self):
+        self.api.session.request.side_effect = requests.ReadTimeout()
+
+        with self.assertRaises(HiboutikTimeoutError):
+            self.api.get_webhooks()
+
+        statuses = self.api.metrics.snapshot()["endpoints"]["GET webhooks"]["statuses"]
+        self.assertEqual(statuses, {"ReadTimeout": 1})
+
+    def test_retries_are_recorded(self):
+        self.api.scheduler.backoff = 0
+        self.api.session.request.side_effect = [
+            Mock(status_code=503, headers={}, content=b""),
+            Mock(status_code=200, headers={}, content=b"[]", json=lambda: []),
+        ]
+
+        self.api.get_webhooks()
+
+        endpoint = self.api.metrics.snapshot()["endpoints"]["GET webhooks"]
+        self.assertEqual(endpoint["calls"], 2)
+        self.assertEqual(endpoint["retries"], 1)
@@ -0,0 +1,294 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+import requests
+
+from opossum.opossum.throttling import (
+    AIMDLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    Deadline,
+    DeadlineExceededError,
+    RequestScheduler,
+    TokenBucket,
+    parse_retry_after,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+def make_response(status_code, headers=None):
+    return Mock(status_code=status_code, headers=headers or {})
+
+
+class TokenBucketTestCase(TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(
+            rate=2, capacity=2, clock=self.clock, sleep=self.clock.sleep
+        )
+
+    def test_burst_does_not_wait(self):
+        self.bucket.acquire()
+        self.bucket.acquire()
+
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_rate_is_enforced_after_burst(self):
+        for _ in range(4):
+            self.bucket.acquire()
+
+        self.assertAlmostEqual(self.clock.now, 1.0)
+
+    def test_pause_holds_back_acquisitions(self):
+        self.bucket.pause(3)
+        self.bucket.acquire()
+
+        self.assertGreaterEqual(self.clock.now, 3.0)
+
+
+class AIMDLimiterTestCase(TestCase):
+    def test_decrease_is_multiplicative(self):
+        limiter = AIMDLimiter(initial=8, maximum=8)
+
+        limiter.on_throttle()
+        self.assertEqual(limiter.limit, 4)
+        limiter.on_throttle()
+        self.assertEqual(limiter.limit, 2)
+
+    def test_increase_is_additive_and_bounded(self):
+        limiter = AIMDLimiter(initial=2, maximum=3)
+
+        for _ in range(2):
+            limiter.on_success()
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(10):
+            limiter.on_success()
+        self.assertEqual(limiter.limit, 3)
+
+    def test_limit_never_goes_below_minimum(self):
+        limiter = AIMDLimiter(initial=1, minimum=1)
+
+        limiter.on_throttle()
+
+        self.assertEqual(limiter.limit, 1)
+
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after(make_response(429, {"Retry-After": "7"})) == 7.0
+
+
+def test_parse_retry_after_http_date():
+    response = make_response(429, {"Retry-After": "Wed, 21 Oct 2015 07:28:10 GMT"})
+
+    assert parse_retry_after(response, clock=lambda: 1445412480.0) == 10.0
+
+
+def test_parse_retry_after_missing():
+    assert parse_retry_after(make_response(429)) is None
+
+
+class RequestSchedulerTestCase(TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.scheduler = RequestScheduler(
+            rate=100,
+            burst=100,
+            max_retries=3,
+            backoff=1,
+            clock=self.clock,
+            sleep=self.clock.sleep,
+        )
+
+    def test_throttled_request_honors_retry_after(self):
+        send = Mock(
+            side_effect=[make_response(429, {"Retry-After": "5"}), make_response(200)]
+        )
+
+        response = self.scheduler.execute("post", send)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(send.call_count, 2)
+        self.assertGreaterEqual(self.clock.now, 5)
+        self.assertEqual(self.scheduler.limiter.limit, 4)
+
+    def test_server_error_is_retried_with_backoff_when_idempotent(self):
+        send = Mock(
+            side_effect=[make_response(503), make_response(502), make_response(200)]
+        )
+
+        response = self.scheduler.execute("get", send)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.clock.sleeps, [1, 2])
+
+    def test_server_error_is_not_retried_when_not_idempotent(self):
+        send = Mock(return_value=make_response(500))
+
+        response = self.scheduler.execute("post", send)
+
+        self.assertEqual(response.status_code, 500)
+        send.assert_called_once()
+
+    def test_gives_up_after_max_retries(self):
+        send = Mock(return_value=make_response(429, {"Retry-After": "1"}))
+
+        response = self.scheduler.execute("get", send)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(send.call_count, 4)
+
+    def test_client_error_is_returned_as_is(self):
+        send = Mock(return_value=make_response(404))
+
+        response = self.scheduler.execute("get", send)
+
+        self.assertEqual(response.status_code, 404)
+        send.assert_called_once()
+
+    def test_retry_is_abandoned_when_it_would_miss_the_deadline(self):
+        send = Mock(return_value=make_response(429, {"Retry-After": "30"}))
+
+        with Deadline(10, clock=self.clock):
+            response = self.scheduler.execute("get", send)
+
+        self.assertEqual(response.status_code, 429)
+        send.assert_called_once()
+
+    def test_expired_deadline_prevents_the_call(self):
+        send = Mock(return_value=make_response(200))
+
+        with Deadline(0, clock=self.clock):
+            with self.assertRaises(DeadlineExceededError):
+                self.scheduler.execute("get", send)
+
+        send.assert_not_called()
+
+    def test_open_circuit_prevents_the_call(self):
+        send = Mock(side_effect=requests.ConnectionError())
+        for _ in range(self.scheduler.breaker.failure_threshold):
+            with self.assertRaises(requests.ConnectionError):
+                self.scheduler.execute("post", send)
+        send.reset_mock()
+
+        with self.assertRaises(CircuitOpenError):
+            self.scheduler.execute("post", send)
+
+        send.assert_not_called()
+
+    def open_circuit(self):
+        send = Mock(return_value=make_response(503))
+        for _ in range(self.scheduler.breaker.failure_threshold):
+            self.scheduler.execute("post", send)
+        self.clock.sleep(self.scheduler.breaker.reset_timeout)
+
+    def test_throttled_trial_lets_the_retry_be_the_trial(self):
+        self.open_circuit()
+        send = Mock(
+            side_effect=[make_response(429, {"Retry-After": "1"}), make_response(200)]
+        )
+
+        response = self.scheduler.execute("get", send)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.scheduler.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_aborted_trial_does_not_hold_the_circuit_open(self):
+        self.open_circuit()
+        self.scheduler.bucket.acquire = Mock(side_effect=DeadlineExceededError())
+
+        with self.assertRaises(DeadlineExceededError):
+            self.scheduler.execute("get", Mock())
+        del self.scheduler.bucket.acquire
+
+        response = self.scheduler.execute("get", Mock(return_value=make_response(200)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.scheduler.breaker.state, CircuitBreaker.CLOSED)
+
+
+class DeadlineTestCase(TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+
+    def test_no_deadline(self):
+        self.assertIsNone(Deadline.remaining())
+        Deadline.check()
+
+    def test_remaining(self):
+        with Deadline(10, clock=self.clock):
+            self.clock.sleep(4)
+            self.assertEqual(Deadline.remaining(), 6)
+        self.assertIsNone(Deadline.remaining())
+
+    def test_nested_deadline_does_not_extend_outer_one(self):
+        with Deadline(5, clock=self.clock):
+            with Deadline(60, clock=self.clock):
+                self.assertEqual(Deadline.remaining(), 5)
+
+
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            failure_threshold=2, reset_timeout=10, clock=self.clock
+        )
+
+    def open_circuit(self):
+        for _ in range(2):
+            self.breaker.before_call()
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.open_circuit()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_success_resets_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_single_trial_after_reset_timeout(self):
+        self.open_circuit()
+        self.clock.sleep(10)
+
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_ended_trial_lets_another_call_through(self):
+        self.open_circuit()
+        self.clock.sleep(10)
+
+        self.assertTrue(self.breaker.before_call())
+        self.breaker.end_trial()
+
+        self.assertTrue(self.breaker.before_call())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+    def test_failed_trial_opens_again(self):
+        self.open_circuit()
+        self.clock.sleep(10)
+
+        self.breaker.before_call()
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
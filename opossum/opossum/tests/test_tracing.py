@@ -0,0 +1,45 @@
+import logging
+from unittest import TestCase
+from unittest.mock import Mock, PropertyMock
+
+from opossum.opossum.tracing import RequestTracer
+
+
+class RequestTracerTestCase(TestCase):
+    def setUp(self) -> None:
+        self.logger = Mock(name="mocked_logger")
+        self.content = PropertyMock(return_value=b'[{"product_id": 1}]')
+        self.response = Mock(status_code=200)
+        type(self.response).content = self.content
+
+    def test_disabled_tracer_does_not_touch_the_response(self):
+        self.logger.isEnabledFor.return_value = False
+        tracer = RequestTracer(logger=self.logger)
+
+        tracer.trace("get", "https://shop/api/products", None, self.response)
+
+        self.logger.debug.assert_not_called()
+        self.content.assert_not_called()
+
+    def test_enabled_tracer_truncates_bodies(self):
+        self.logger.isEnabledFor.return_value = True
+        tracer = RequestTracer(logger=self.logger, max_body_length=5)
+
+        tracer.trace("post", "https://shop/api/products", "a=1", self.response)
+
+        self.logger.isEnabledFor.assert_called_with(logging.DEBUG)
+        args = self.logger.debug.call_args[0]
+        self.assertEqual(args[1:4], ("POST", "https://shop/api/products", "a=1"))
+        self.assertEqual(args[5], '[{"pr... (19 total)')
+
+    def test_sampling(self):
+        self.logger.isEnabledFor.return_value = True
+        draws = iter([0.05, 0.5])
+        tracer = RequestTracer(
+            logger=self.logger, sample_rate=0.1, random=lambda: next(draws)
+        )
+
+        tracer.trace("get", "https://shop/api/products", None, self.response)
+        tracer.trace("get", "https://shop/api/products", None, self.response)
+
+        self.logger.debug.assert_called_once()
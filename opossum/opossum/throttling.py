@@ -0,0 +1,359 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from logging import getLogger
+from typing import Callable
+
+import requests
+
+LOGGER = getLogger(__name__)
+
+#: Sustained number of requests per second sent to a Hiboutik instance.
+DEFAULT_RATE = 5.0
+#: Number of requests that can be sent at once after an idle period.
+DEFAULT_BURST = 10
+#: Upper bound of the adaptive number of requests in flight.
+DEFAULT_MAX_CONCURRENCY = 8
+#: Number of retries of a throttled or failed request before giving up.
+DEFAULT_MAX_RETRIES = 5
+#: First delay, in seconds, of the exponential backoff when no Retry-After is given.
+DEFAULT_BACKOFF = 0.5
+#: Number of consecutive failures after which calls are not attempted anymore.
+DEFAULT_FAILURE_THRESHOLD = 5
+#: Delay, in seconds, before a single call is attempted again after the circuit opened.
+DEFAULT_RESET_TIMEOUT = 30.0
+
+#: These methods can be retried after a server error without risking a duplicate.
+IDEMPOTENT_METHODS = {"get", "head", "put", "delete", "options"}
+
+THROTTLED_STATUS = 429
+RETRYABLE_SERVER_STATUSES = {500, 502, 503, 504}
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class Deadline:
+    """Upper bound on the wall time of an operation spanning several requests.
+
+    Used as a context manager, it applies to the requests made by the current
+    thread. Nested deadlines never extend the enclosing one."""
+
+    _local = threading.local()
+
+    def __init__(self, seconds: float, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self.expires_at = clock() + seconds
+
+    def __enter__(self):
+        stack = self._stack()
+        if stack and stack[-1].expires_at < self.expires_at:
+            self.expires_at = stack[-1].expires_at
+        stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack().pop()
+
+    @classmethod
+    def _stack(cls) -> list:
+        if not hasattr(cls._local, "stack"):
+            cls._local.stack = []
+        return cls._local.stack
+
+    @classmethod
+    def current(cls) -> "Deadline" or None:
+        """The deadline of the current thread, to carry it over to worker threads."""
+        stack = cls._stack()
+        return stack[-1] if stack else None
+
+    @classmethod
+    def remaining(cls) -> float or None:
+        """Seconds left to the current thread's deadline, None without deadline."""
+        stack = cls._stack()
+        if not stack:
+            return None
+        return stack[-1].expires_at - stack[-1]._clock()
+
+    @classmethod
+    def check(cls):
+        remaining = cls.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceededError("Operation deadline exceeded")
+
+
+class CircuitBreaker:
+    """Fails fast while the remote service is degraded.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls
+    are refused for `reset_timeout` seconds. Then a single trial call is let
+    through: its success closes the circuit, its failure opens it again. A trial
+    that tells nothing about the server health, such as a throttled or an aborted
+    call, leaves the circuit half-open for the next call to be the trial."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout=DEFAULT_RESET_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._clock() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before_call(self) -> bool:
+        """Raises CircuitOpenError if the call must not be attempted.
+
+        Returns True when the call is the trial of a half-open circuit, which
+        must then be ended by `end_trial` whatever its outcome."""
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+        raise CircuitOpenError("Hiboutik is unavailable, call not attempted")
+
+    def end_trial(self):
+        """Lets another call be the trial if this one recorded no outcome."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+            self._trial_in_flight = False
+
+
+class TokenBucket:
+    """Lets through `rate` acquisitions per second, with bursts up to `capacity`."""
+
+    def __init__(
+        self,
+        rate=DEFAULT_RATE,
+        capacity=DEFAULT_BURST,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(capacity)
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # `_updated_at` is in the future while the bucket is paused.
+        if now > self._updated_at:
+            elapsed = now - self._updated_at
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated_at = now
+
+    def acquire(self):
+        """Takes a token, blocking until it is actually available.
+
+        The token is reserved right away, so that concurrent callers queue up
+        in order instead of competing for the next refill."""
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self._tokens -= 1
+            paused_for = max(0.0, self._updated_at - now)
+            wait = paused_for + max(0.0, -self._tokens) / self.rate
+        if wait > 0:
+            self._sleep(wait)
+
+    def pause(self, delay: float):
+        """Holds back every acquisition for `delay` seconds and drains the burst."""
+        with self._lock:
+            resume_at = self._clock() + delay
+            if resume_at > self._updated_at:
+                self._updated_at = resume_at
+            self._tokens = min(0.0, self._tokens)
+
+
+class AIMDLimiter:
+    """Bounds the number of requests in flight, adapting the bound to the server health.
+
+    The limit grows additively (by about one slot per window of successful
+    requests) and is cut multiplicatively when the server pushes back."""
+
+    def __init__(
+        self,
+        initial=DEFAULT_MAX_CONCURRENCY,
+        minimum=1,
+        maximum=DEFAULT_MAX_CONCURRENCY,
+        decrease_factor=0.5,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(self.minimum, int(self._limit))
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def on_success(self):
+        with self._condition:
+            self._limit = min(self.maximum, self._limit + 1 / self._limit)
+            self._condition.notify()
+
+    def on_throttle(self):
+        with self._condition:
+            self._limit = max(self.minimum, self._limit * self.decrease_factor)
+
+
+def parse_retry_after(response: requests.Response, clock=time.time) -> float or None:
+    """Returns the delay in seconds requested by the Retry-After header, if any."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - clock())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """Sends requests at the highest rate the Hiboutik instance sustains.
+
+    Requests go through a token bucket and an AIMD concurrency limiter.
+    Throttled requests (429) are retried after the Retry-After delay, during
+    which no other request is sent. Server errors are retried with an
+    exponential backoff, for idempotent methods only. Retries stop at the
+    current `Deadline`, and a circuit breaker refuses requests while the
+    server keeps failing."""
+
+    def __init__(
+        self,
+        rate=DEFAULT_RATE,
+        burst=DEFAULT_BURST,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        max_retries=DEFAULT_MAX_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        breaker: CircuitBreaker = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.bucket = TokenBucket(rate, burst, clock=clock, sleep=sleep)
+        self.limiter = AIMDLimiter(max_concurrency, maximum=max_concurrency)
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._sleep = sleep
+
+    def _should_retry(self, method: str, response: requests.Response) -> bool:
+        if response.status_code == THROTTLED_STATUS:
+            return True
+        return (
+            response.status_code in RETRYABLE_SERVER_STATUSES
+            and method.lower() in IDEMPOTENT_METHODS
+        )
+
+    def execute(
+        self, method: str, send: Callable[[], requests.Response]
+    ) -> requests.Response:
+        """Calls `send` until it gets a final response or runs out of retries.
+
+        Raises DeadlineExceededError when the current deadline is over and
+        CircuitOpenError when the server is considered down."""
+        attempt = 0
+        while True:
+            Deadline.check()
+            is_trial = self.breaker.before_call()
+            try:
+                self.bucket.acquire()
+                with self.limiter:
+                    try:
+                        response = send()
+                    except requests.RequestException:
+                        self.breaker.record_failure()
+                        raise
+
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                elif response.status_code != THROTTLED_STATUS:
+                    self.breaker.record_success()
+            finally:
+                # A throttled or aborted trial must not hold the circuit open
+                if is_trial:
+                    self.breaker.end_trial()
+
+            if not self._should_retry(method, response):
+                self.limiter.on_success()
+                return response
+
+            self.limiter.on_throttle()
+            if attempt >= self.max_retries:
+                return response
+
+            delay = parse_retry_after(response)
+            if delay is None:
+                delay = self.backoff * 2 ** attempt
+            remaining = Deadline.remaining()
+            if remaining is not None and delay >= remaining:
+                return response
+            LOGGER.info(
+                "Hiboutik answered %s, retrying in %.2fs", response.status_code, delay
+            )
+            if response.status_code == THROTTLED_STATUS:
+                self.bucket.pause(delay)
+            else:
+                self._sleep(delay)
+            attempt += 1
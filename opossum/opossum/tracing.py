@@ -0,0 +1,59 @@
+import logging
+import random
+from typing import Callable
+
+import requests
+
+LOGGER = logging.getLogger("opossum.opossum.hiboutik")
+
+#: Number of characters of a request or response body kept in a trace.
+DEFAULT_MAX_BODY_LENGTH = 1000
+
+
+def _truncate(body, max_length: int) -> str:
+    if body is None:
+        return ""
+    if isinstance(body, bytes):
+        text = body[:max_length].decode("utf-8", "replace")
+        truncated = len(body) > max_length
+    else:
+        text = str(body)
+        truncated = len(text) > max_length
+        text = text[:max_length]
+    if truncated:
+        return f"{text}... ({len(body)} total)"
+    return text
+
+
+class RequestTracer:
+    """Logs the requests sent to Hiboutik along with their responses.
+
+    Nothing is formatted or decoded unless the logger is enabled for DEBUG.
+    When it is, only a `sample_rate` share of the requests is traced, and
+    bodies are cut to `max_body_length` characters."""
+
+    def __init__(
+        self,
+        logger: logging.Logger = LOGGER,
+        sample_rate: float = 1.0,
+        max_body_length: int = DEFAULT_MAX_BODY_LENGTH,
+        random: Callable[[], float] = random.random,
+    ):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.max_body_length = max_body_length
+        self._random = random
+
+    def trace(self, method: str, url: str, data, response: requests.Response):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.sample_rate < 1.0 and self._random() >= self.sample_rate:
+            return
+        self.logger.debug(
+            "HIBOUTIK %s %s %s > %s %s",
+            method.upper(),
+            url,
+            _truncate(data, self.max_body_length),
+            response.status_code,
+            _truncate(response.content, self.max_body_length),
+        )
@@ -0,0 +1,9 @@
+from __future__ import unicode_literals
+
+import frappe
+
+
+def execute():
+    """Creates the Item custom fields added since the sync was enabled, such as
+    the Hiboutik Fingerprint."""
+    frappe.get_single("Hiboutik Settings").create_custom_fields()